@@ -1,20 +1,21 @@
+import contextlib
 import json
 import mpd
 import os
+import re
 
+from metrics import MPDClient
+
+
+# Bytes of commands sent in one command list at most, half MPD's default limit
+COMMAND_LIST_BYTES = 1024 * 1024
 
-def init_client(client):
-    if client:
-        try:
-            client.ping()
-            return client
-        except mpd.base.ConnectionError:
-            pass
 
+def connect_client():
     hostname = os.getenv("WEMPD_MPD_HOST", "localhost")
     port = int(os.getenv("WEMPD_MPD_PORT", "6600"))
 
-    client = mpd.MPDClient()
+    client = MPDClient()
     client.connect(hostname, port)
 
     #sock_name = client._sock.getpeername()
@@ -33,13 +34,13 @@ def remove_path_prefix(path):
     return path
 
 
-def get_status(client):
+def get_status(client, since=None):
     sock_name = client._sock.getpeername()
     return {
         "status": client.status(),
         "currentsong": client.currentsong(),
         "connection": f"{sock_name[0]}:{sock_name[1]}",
-        "queue": list_queue(client),
+        "queue": list_queue(client) if since is None else queue_changes(client, since),
         "version": client.mpd_version,
     }
 
@@ -68,38 +69,52 @@ def info_pairs(data, allowed_fields=None):
     return cmd
 
 
-def list_artists(client):
-    return [a["artist"] for a in client.list("artist")]
+def simplify_title(song):
+    keys = ("track", "title", "name", "file", "artist", "albumartist", "album")
+    return {key: value for (key, value) in song.items() if key in keys}
 
 
-def list_albumartists(client):
-    return [a["albumartist"] for a in client.list("albumartist")]
+def simplify_title_list(titles):
+    return [simplify_title(s) for s in titles]
 
 
-def list_albums(client, query):
-    pairs = info_pairs(query, ("artist", "albumartist"))
-    return [a["album"] for a in client.list("album", *pairs)]
+def int_param(query, key, default=0):
+    try:
+        return max(0, int(query.get(key) or default))
+    except ValueError:
+        return default
 
 
-def simplify_title_list(titles):
-    keys = ("track", "title", "name", "file", "artist", "albumartist", "album")
-    return [{key: value for (key, value) in s.items() if key in keys} for s in titles]
+def paginate(items, query):
+    offset = int_param(query, "offset")
+    limit = int_param(query, "limit")
+    if limit:
+        return items[offset : offset + limit]
+    if offset:
+        return items[offset:]
+    return items
 
 
-def list_titles(client, query):
-    if "playlist" in query:
-        titles = client.listplaylistinfo(query["playlist"])
+def page_window(query):
+    # Lets MPD do the slicing for find and search
+    offset = int_param(query, "offset")
+    limit = int_param(query, "limit")
+    if limit:
+        return ["window", (offset, offset + limit)]
+    if offset:
+        return ["window", (offset,)]
+    return []
 
-    else:
-        pairs = info_pairs(
-            query, ("artist", "albumartist", "album", "genre", "originaldate", "label")
-        )
-        if pairs:
-            titles = client.find(*pairs)
-        else:
-            titles = client.list("title")
 
-    return simplify_title_list(titles)
+@contextlib.contextmanager
+def iterating(client):
+    # Results are read from MPD as they are consumed, they have to be
+    # consumed fully before the next command.
+    client.iterate = True
+    try:
+        yield
+    finally:
+        client.iterate = False
 
 
 def list_queue(client):
@@ -110,65 +125,252 @@ def list_queue(client):
     return queue
 
 
+def queue_changes(client, since):
+    # Only the songs that changed after playlist version since. Applying the
+    # changes by position and truncating to length gives the current queue.
+    client.command_list_ok_begin()
+    client.status()
+    client.plchanges(since)
+    status, changes = client.command_list_end()
+    return queue_delta(client, status, since, changes)
+
+
+def queue_delta(client, status, since, changes):
+    version = int(status["playlist"])
+    if since > version:
+        # MPD restarted and its version went backwards, start over
+        since = 0
+        changes = client.plchanges(since)
+
+    return {
+        "version": version,
+        "length": int(status["playlistlength"]),
+        "full": since == 0,
+        "song": status.get("song"),
+        "state": status["state"],
+        "changes": changes,
+    }
+
+
+def queue_range(start, end=None):
+    # MPD's START:END, open ended without an end
+    return (int(start),) if end is None else (int(start), int(end))
+
+
+def batch_command(op):
+    # (command, args) for one /api/batch operation, positions are those after
+    # the operations before it.
+    kind = op.get("op")
+    if kind == "move":
+        source = op["from"]
+        source = queue_range(*source) if isinstance(source, list) else int(source)
+        return "move", (source, int(op["to"]))
+    if kind == "moveid":
+        return "moveid", (int(op["id"]), int(op["to"]))
+    if kind == "delete":
+        return "delete", (queue_range(op["from"], op.get("to")),)
+    if kind == "deleteid":
+        return "deleteid", (int(op["id"]),)
+    if kind == "addid":
+        pos = op.get("pos")
+        if pos is None:
+            return "addid", (op["file"],)
+        # Relative positions like "+0", right after the current song, are kept
+        if not re.fullmatch(r"[+-]?\d+", str(pos)):
+            raise ValueError(f"Invalid position {pos!r}")
+        return "addid", (op["file"], str(pos))
+    if kind == "play":
+        return "play", () if op.get("pos") is None else (int(op["pos"]),)
+    raise ValueError(f"Unknown operation {kind!r}")
+
+
+def batch_commands(ops):
+    if not isinstance(ops, list):
+        raise ValueError("Parameter 'ops' should be a list")
+
+    commands = []
+    for i, op in enumerate(ops):
+        try:
+            commands.append(batch_command(op))
+        except KeyError as e:
+            raise ValueError(f"Operation {i} is missing {e}") from e
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ValueError(f"Invalid operation {i}: {e}") from e
+    return commands
+
+
+def run_batch(client, commands, since=None):
+    # All in one command list, with the queue version or changes after it.
+    # MPD stops at the first command that fails, keeping the ones before.
+    client.command_list_ok_begin()
+    for command, args in commands:
+        getattr(client, command)(*args)
+    client.status()
+    if since is not None:
+        client.plchanges(since)
+    results = client.command_list_end()
+
+    if since is None:
+        status = results[-1]
+        return {
+            "results": results[:-1],
+            "version": int(status["playlist"]),
+            "length": int(status["playlistlength"]),
+        }
+
+    queue = queue_delta(client, results[-2], since, results[-1])
+    return {
+        "results": results[:-2],
+        "version": queue["version"],
+        "length": queue["length"],
+        "queue": queue,
+    }
+
+
+def batch_failure(client, error, since=None):
+    # Where the list stopped, from MPD's "[error@index] {command} message"
+    m = re.match(r"\[\d+@(\d+)\]", str(error))
+    result = {"error": str(error), "failed": int(m.group(1)) if m else None}
+    if since is None:
+        status = client.status()
+        result["version"] = int(status["playlist"])
+        result["length"] = int(status["playlistlength"])
+    else:
+        queue = queue_changes(client, since)
+        result.update(version=queue["version"], length=queue["length"], queue=queue)
+    return result
+
+
 def list_playlists(client):
     return [p["playlist"] for p in client.listplaylists()]
 
 
-def remove_from_queue_by_search(client, what, search):
-    queue = client.playlistinfo()
-    removed = 0
-    for song in queue:
-        if song.get(what) == search:
-            client.deleteid(song["id"])
-            removed += 1
+def position_ranges(positions):
+    # Contiguous (start, end) runs, last first so that deleting one doesn't
+    # move the ones still to go
+    ranges = []
+    for pos in sorted(set(positions), reverse=True):
+        if ranges and ranges[-1][0] == pos + 1:
+            ranges[-1][0] = pos
+        else:
+            ranges.append([pos, pos + 1])
+    return [tuple(r) for r in ranges]
+
 
-    return removed
+def delete_positions(client, positions):
+    ranges = position_ranges(positions)
+    if ranges:
+        client.command_list_ok_begin()
+        for songs in ranges:
+            client.delete(songs)
+        client.command_list_end()
+    return sum(end - start for start, end in ranges)
+
+
+def remove_from_queue_by_search(client, searches):
+    # Songs matching any of the (tag, value) pairs, found by MPD
+    if not searches:
+        return 0
+    client.command_list_ok_begin()
+    for what, search in searches:
+        client.playlistfind(what, search)
+    found = client.command_list_end()
+    return delete_positions(
+        client, (int(song["pos"]) for songs in found for song in songs)
+    )
 
 
 def remove_from_queue_by_id(client, ids):
-    removed = 0
-    for song_id in ids:
+    # The ids are queue positions, those not in the queue are skipped
+    length = int(client.status()["playlistlength"])
+    positions = []
+    for pos in ids:
         try:
-            client.delete(song_id)
-            removed += 1
-        except mpd.base.CommandError:
-            pass
+            pos = int(pos)
+        except (TypeError, ValueError):
+            continue
+        if 0 <= pos < length:
+            positions.append(pos)
+    return delete_positions(client, positions)
 
-    return removed
 
+def mpd_version_at_least(client, version):
+    return tuple(int(v) for v in client.mpd_version.split(".")[:3]) >= version
 
-def insert(client, query, append=False):
-    start_pos = 0
+
+def insert_position(status, append):
     if append:
-        start_pos = len(client.playlist())
-    else:
-        status = client.status()
-        if "song" in status:
-            start_pos = int(status["song"]) + 1
+        return int(status["playlistlength"])
+    if "song" in status:
+        return int(status["song"]) + 1
+    return 0
+
+
+def add_files(client, files, start_pos):
+    # Pipelined, in command lists kept under MPD's max_command_list_size (2 MiB
+    # by default) as it hangs up on longer ones
+    listed = None
+    for i, file in enumerate(files, start=start_pos):
+        if listed is None:
+            client.command_list_ok_begin()
+            listed = 0
+        client.addid(file, i)
+        listed += len(file.encode("utf-8")) + 32
+        if listed >= COMMAND_LIST_BYTES:
+            client.command_list_end()
+            listed = None
+    if listed is not None:
+        client.command_list_end()
+    return len(files)
+
+
+def find_add(client, pairs, append):
+    if not mpd_version_at_least(client, (0, 23)):
+        client.command_list_ok_begin()
+        client.status()
+        client.find(*pairs)
+        status, songs = client.command_list_end()
+        files = [song["file"] for song in songs]
+        return add_files(client, files, insert_position(status, append))
+
+    def count_and_add(*position):
+        client.command_list_ok_begin()
+        client.count(*pairs)
+        client.findadd(*pairs, *position)
+        counts, _ = client.command_list_end()
+        return int(counts["songs"])
+
+    if append:
+        return count_and_add()
+
+    try:
+        return count_and_add("position", "+0")
+    except mpd.base.CommandError:
+        # Relative positions fail when there is no current song
+        return count_and_add("position", 0)
+
 
-    count = 0
+def insert(client, query, append=False):
     if "playlist" in query:
+        client.command_list_ok_begin()
+        client.status()
         if append:
             client.load(query["playlist"])
-        else:
-            playlist = client.listplaylist(query["playlist"])
-            for i, song in enumerate(playlist, start=start_pos):
-                client.addid(song, i)
-                count += 1
+            client.status()
+            before, _, after = client.command_list_end()
+            return int(after["playlistlength"]) - int(before["playlistlength"])
+
+        client.listplaylist(query["playlist"])
+        status, playlist = client.command_list_end()
+        return add_files(client, playlist, insert_position(status, append))
 
     elif query.get("file"):
-        client.addid(query["file"], start_pos)
-        count += 1
+        status = client.status()
+        client.addid(query["file"], insert_position(status, append))
+        return 1
 
     elif "find" in query:
-        for i, song in enumerate(client.find(*query["find"]), start=start_pos):
-            client.addid(song["file"], i)
-            count += 1
+        return find_add(client, query["find"], append)
 
     else:
-        pairs = info_pairs(query)
-        for i, song in enumerate(client.find(*pairs), start=start_pos):
-            client.addid(song["file"], i)
-            count += 1
-
-    return count
+        return find_add(client, info_pairs(query), append)
@@ -0,0 +1,321 @@
+import collections
+import concurrent.futures
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import mpd
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+from api import mpd_version_at_least
+from cache import library_cache
+
+
+# Thumbnails are scaled to fit one of these, so each picture has only a few
+THUMBNAIL_SIZES = (64, 128, 256, 512, 1024)
+THUMBNAIL_QUALITY = int(os.getenv("WEMPD_THUMBNAIL_QUALITY", "80"))
+WEBP = Image is not None and features.check("webp")
+
+
+def default_cache_dir():
+    base = os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(base, "wempd", "art")
+
+
+def fetch_art(client, file):
+    if mpd_version_at_least(client, (0, 22)):
+        pic = client.readpicture(file)
+    else:
+        pic = client.albumart(file)
+    return pic.get("binary"), pic.get("type", "image/jpg")
+
+
+def thumbnail_size(size):
+    for thumbnail in THUMBNAIL_SIZES:
+        if size <= thumbnail:
+            return thumbnail
+    return THUMBNAIL_SIZES[-1]
+
+
+def thumbnail_format(accept):
+    return "webp" if WEBP and "image/webp" in (accept or "") else "jpeg"
+
+
+def make_thumbnail(data, size, fmt):
+    # The picture scaled down to fit size, None if it already does
+    with Image.open(io.BytesIO(data)) as img:
+        if max(img.size) <= size:
+            return None
+        # JPEGs decode straight to about the right size, far quicker
+        img.draft("RGB", (size, size))
+        alpha = img.mode in ("RGBA", "LA") or "transparency" in img.info
+        img = img.convert("RGBA" if alpha and fmt == "webp" else "RGB")
+        img.thumbnail((size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        img.save(out, fmt, quality=THUMBNAIL_QUALITY)
+        return out.getvalue()
+
+
+class ArtCache:
+    def __init__(self, directory, max_bytes, resize_workers=2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.blob_dir = os.path.join(directory, "blobs")
+        # Per song, as tracks of one album can have different art or none.
+        # Pictures they share are stored once, by digest.
+        self.song_dir = os.path.join(directory, "songs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.song_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        # digest -> size, least recently used first
+        self.blobs = collections.OrderedDict()
+        self.total_bytes = 0
+        # Songs without art, with the database version they were checked at
+        self.missing = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Thumbnails are made on threads of their own so a few requests for
+        # big pictures can't take all the CPU. Blob name -> future, while
+        # being made.
+        self.resizer = concurrent.futures.ThreadPoolExecutor(
+            max_workers=resize_workers, thread_name_prefix="art-resize"
+        )
+        self.resizing = {}
+        # (digest, size) of pictures no bigger than size
+        self.unscaled = set()
+        self.resized = 0
+        self.resize_seconds = 0
+        self.load()
+
+    def load(self):
+        entries = []
+        with os.scandir(self.blob_dir) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.startswith("."):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, digest, size in sorted(entries):
+            self.blobs[digest] = size
+            self.total_bytes += size
+        self.evict()
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest)
+
+    def song_path(self, file):
+        name = hashlib.sha1(file.encode("utf-8")).hexdigest()
+        return os.path.join(self.song_dir, name)
+
+    def write_atomic(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and self.blobs:
+            digest, size = self.blobs.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.unlink(self.blob_path(digest))
+            except FileNotFoundError:
+                pass
+
+    def read_song(self, file):
+        try:
+            with open(self.song_path(file), "rb") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        version = library_cache.version
+        if version is not None and meta.get("version") != version:
+            return None
+        return meta
+
+    def open_blob(self, meta):
+        try:
+            f = open(self.blob_path(meta["digest"]), "rb")
+        except FileNotFoundError:
+            return None
+
+        with self.lock:
+            if meta["digest"] in self.blobs:
+                self.blobs.move_to_end(meta["digest"])
+        os.utime(f.fileno())
+        return f
+
+    def add_blob(self, name, binary):
+        with self.lock:
+            known = name in self.blobs
+        if not known:
+            self.write_atomic(self.blob_path(name), binary)
+            with self.lock:
+                if name not in self.blobs:
+                    self.blobs[name] = len(binary)
+                    self.total_bytes += len(binary)
+                self.evict()
+
+    def store(self, file, binary, content_type):
+        digest = hashlib.sha256(binary).hexdigest()
+        self.add_blob(digest, binary)
+
+        meta = {
+            "digest": digest,
+            "type": content_type,
+            "size": len(binary),
+            "version": library_cache.version,
+        }
+        self.write_atomic(self.song_path(file), json.dumps(meta).encode("utf-8"))
+        return meta
+
+    def open(self, client, file, size=None, fmt="jpeg", count=True):
+        # Returns (file object, meta) for the art of file, or None. With a
+        # size, a thumbnail that fits it if Pillow is installed. Prefetching
+        # isn't counted in the hits and misses.
+        art = self.open_original(client, file, count)
+        if art is None or not size or Image is None:
+            return art
+        return self.open_thumbnail(*art, thumbnail_size(size), fmt)
+
+    def open_original(self, client, file, count=True):
+        meta = self.read_song(file)
+        if meta is not None:
+            f = self.open_blob(meta)
+            if f is not None:
+                with self.lock:
+                    self.hits += count
+                return f, meta
+
+        with self.lock:
+            self.misses += count
+            version = self.missing.get(file)
+        if version is not None and version == library_cache.version:
+            return None
+
+        try:
+            binary, content_type = fetch_art(client, file)
+        except mpd.base.CommandError:
+            binary = None
+
+        if not binary:
+            with self.lock:
+                self.missing[file] = library_cache.version
+            return None
+
+        try:
+            meta = self.store(file, binary, content_type)
+            f = self.open_blob(meta)
+        except OSError as e:
+            logging.warning("Could not cache art for %s: %s", file, e)
+            f = None
+
+        if f is None:
+            # The cache is unwritable or the blob was evicted straight away
+            f = tempfile.TemporaryFile()
+            f.write(binary)
+            f.seek(0)
+            meta = {
+                "digest": hashlib.sha256(binary).hexdigest(),
+                "type": content_type,
+                "size": len(binary),
+            }
+        return f, meta
+
+    def open_thumbnail(self, f, meta, size, fmt):
+        # The original when it's small enough already, can't be decoded or
+        # takes too long.
+        name = f"{meta['digest']}-{size}.{fmt}"
+        thumbnail = {"digest": name, "type": f"image/{fmt}"}
+        thumb = self.open_blob(thumbnail)
+        if thumb is None:
+            with self.lock:
+                unscaled = (meta["digest"], size) in self.unscaled
+                future = self.resizing.get(name)
+            if unscaled:
+                return f, meta
+            if future is None:
+                data = f.read()
+                f.seek(0)
+                with self.lock:
+                    future = self.resizing.get(name)
+                    if future is None:
+                        future = self.resizing[name] = self.resizer.submit(
+                            self.resize, data, meta["digest"], name, size, fmt
+                        )
+            try:
+                binary = future.result(timeout=30)
+            except concurrent.futures.TimeoutError:
+                logging.warning("Timed out making a thumbnail of %s", meta["digest"])
+                binary = None
+            if binary is None:
+                return f, meta
+
+            thumb = self.open_blob(thumbnail)
+            if thumb is None:
+                thumb = io.BytesIO(binary)
+
+        f.close()
+        thumb.seek(0, os.SEEK_END)
+        thumbnail["size"] = thumb.tell()
+        thumb.seek(0)
+        return thumb, thumbnail
+
+    def resize(self, data, digest, name, size, fmt):
+        started = time.monotonic()
+        try:
+            binary = make_thumbnail(data, size, fmt)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            logging.warning("Could not make a thumbnail of %s: %s", digest, e)
+            binary = None
+
+        try:
+            if binary is None:
+                with self.lock:
+                    self.unscaled.add((digest, size))
+                return None
+            self.add_blob(name, binary)
+        except OSError as e:
+            logging.warning("Could not cache thumbnail %s: %s", name, e)
+        finally:
+            with self.lock:
+                self.resizing.pop(name, None)
+                self.resized += binary is not None
+                self.resize_seconds += time.monotonic() - started
+        return binary
+
+    def stats(self):
+        with self.lock:
+            return {
+                "blobs": len(self.blobs),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resized": self.resized,
+                "resize_seconds": round(self.resize_seconds, 3),
+            }
+
+
+art_cache = ArtCache(
+    os.getenv("WEMPD_ART_CACHE_DIR", default_cache_dir()),
+    int(os.getenv("WEMPD_ART_CACHE_SIZE", "256")) * 1024 * 1024,
+    int(os.getenv("WEMPD_ART_RESIZE_WORKERS", "2")),
+)
@@ -0,0 +1,876 @@
+# A stand-in for MPD that speaks enough of the protocol for wempd, serving a
+# synthetic library with generated album art. It counts the commands and
+# round trips it is sent, for the benchmarks.
+import hashlib
+import io
+import random
+import re
+import select
+import shlex
+import socketserver
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+MPD_VERSION = "0.23.5"
+BINARY_LIMIT = 8192
+SUBSYSTEMS = (
+    "database",
+    "update",
+    "stored_playlist",
+    "playlist",
+    "player",
+    "mixer",
+    "output",
+    "options",
+    "partition",
+    "sticker",
+    "subscription",
+    "message",
+    "neighbor",
+    "mount",
+)
+
+GENRES = [
+    "Rock",
+    "Pop",
+    "Jazz",
+    "Classical",
+    "Electronic",
+    "Folk",
+    "Hip-Hop",
+    "Blues",
+    "Soul",
+    "Metal",
+    "Ambient",
+    "Country",
+]
+LABELS = [f"Label {i}" for i in range(40)]
+WORDS = (
+    "love night day heart time blue light road river fire rain dream "
+    "home star moon sun city song dance ghost golden silver wild young "
+    "summer winter morning evening ocean mountain shadow glass paper"
+).split()
+
+
+class MPDError(Exception):
+    def __init__(self, code, msg):
+        super().__init__(msg)
+        self.code = code
+        self.msg = msg
+
+
+def make_library(songs=10000, tracks_per_album=10, albums_per_artist=5, seed=1):
+    rng = random.Random(seed)
+    library = []
+    album_count = max(1, songs // tracks_per_album)
+    for album_index in range(album_count):
+        artist_index = album_index // albums_per_artist
+        artist = f"Artist {artist_index:05d}"
+        album = " ".join(rng.choice(WORDS).title() for _ in range(2))
+        album = f"{album} {album_index:05d}"
+        genre = rng.choice(GENRES)
+        if rng.random() < 0.2:
+            genre += ";" + rng.choice(GENRES)
+        year = 1950 + rng.randrange(75)
+        label = rng.choice(LABELS)
+        for track in range(1, tracks_per_album + 1):
+            title = " ".join(rng.choice(WORDS).title() for _ in range(3))
+            song_artist = artist
+            if rng.random() < 0.05:
+                song_artist = f"{artist} feat. Guest {rng.randrange(100)}"
+            duration = 120 + rng.random() * 300
+            library.append(
+                {
+                    "file": f"{artist}/{album}/{track:02d} - {title}.flac",
+                    "Last-Modified": "2024-01-01T00:00:00Z",
+                    "Format": "44100:16:2",
+                    "Artist": song_artist,
+                    "AlbumArtist": artist,
+                    "ArtistSort": song_artist,
+                    "AlbumArtistSort": artist,
+                    "Title": title,
+                    "Album": album,
+                    "Track": str(track),
+                    "Date": str(year),
+                    "OriginalDate": f"{year}-01-01",
+                    "Genre": genre,
+                    "Label": label,
+                    "Time": str(int(duration)),
+                    "duration": f"{duration:.3f}",
+                }
+            )
+    return library
+
+
+def unquote_args(line):
+    lexer = shlex.shlex(line, posix=True)
+    lexer.whitespace_split = True
+    lexer.escape = "\\"
+    lexer.quotes = '"'
+    lexer.escapedquotes = '"'
+    return list(lexer)
+
+
+def tag_value(song, tag):
+    tag = tag.lower()
+    if tag == "file":
+        return song["file"]
+    for key, value in song.items():
+        if key.lower() == tag:
+            return value
+    return ""
+
+
+def parse_expression(expr):
+    expr = expr.strip()
+    if not (expr.startswith("(") and expr.endswith(")")):
+        raise MPDError(2, f"Malformed filter: {expr}")
+    inner = expr[1:-1].strip()
+
+    if inner.startswith("("):
+        parts = []
+        depth = 0
+        start = 0
+        for i, char in enumerate(inner):
+            if char == "(":
+                if depth == 0:
+                    start = i
+                depth += 1
+            elif char == ")":
+                depth -= 1
+                if depth == 0:
+                    parts.append(parse_expression(inner[start : i + 1]))
+        return lambda song: all(p(song) for p in parts)
+
+    match = re.fullmatch(r"(\w+)\s+(==|!=|contains|=~|!~|starts_with)\s+'(.*)'", inner)
+    if not match:
+        raise MPDError(2, f"Malformed filter: {expr}")
+    tag, op, value = match.groups()
+    value = value.replace("\\'", "'").replace("\\\\", "\\")
+
+    def check(song):
+        have = tag_value(song, tag)
+        if op == "==":
+            return have == value
+        if op == "!=":
+            return have != value
+        if op == "contains":
+            return value in have
+        if op == "starts_with":
+            return have.startswith(value)
+        if op == "=~":
+            return re.search(value, have) is not None
+        return re.search(value, have) is None
+
+    return check
+
+
+def parse_filter(args, exact=True):
+    # Returns (predicate, remaining args) for both filter syntaxes.
+    checks = []
+    while args:
+        if args[0].lower() in ("group", "sort", "window", "position"):
+            break
+        if args[0].startswith("("):
+            checks.append(parse_expression(args[0]))
+            args = args[1:]
+            continue
+        if len(args) < 2:
+            raise MPDError(2, "Incorrect number of arguments")
+        tag, value = args[0], args[1]
+        args = args[2:]
+        if exact:
+            checks.append(lambda s, t=tag, v=value: tag_value(s, t) == v)
+        elif tag.lower() == "any":
+            needle = value.lower()
+            checks.append(
+                lambda s, n=needle: any(
+                    n in v.lower() for k, v in s.items() if k != "Last-Modified"
+                )
+            )
+        else:
+            needle = value.lower()
+            checks.append(lambda s, t=tag, n=needle: n in tag_value(s, t).lower())
+    return (lambda song: all(c(song) for c in checks)), args
+
+
+def make_art(seed, size):
+    # A real 1200px JPEG when Pillow is around, so thumbnails can be made of
+    # it, padded out to size. Decoders stop at the end of the image.
+    image = b""
+    if Image is not None:
+        img = Image.new("RGB", (1200, 1200), tuple(seed[:3]))
+        img.paste(tuple(seed[3:6]), (200, 200, 1000, 1000))
+        out = io.BytesIO()
+        img.save(out, "jpeg", quality=90)
+        image = out.getvalue()
+    padding = seed * (size // len(seed) + 1)
+    return (image + padding)[: max(size, len(image))]
+
+
+def parse_range(arg, length):
+    if ":" in arg:
+        start, _, end = arg.partition(":")
+        return int(start or 0), int(end) if end else length
+    return int(arg), int(arg) + 1
+
+
+class FakeMPD:
+    def __init__(self, library, art_size=200000, playlists=None):
+        self.lock = threading.RLock()
+        self.library = library
+        self.by_file = {s["file"]: s for s in library}
+        self.art_size = art_size
+        self.art_blobs = {}
+        self.queue = []
+        self.next_id = 1
+        self.playlist_version = 1
+        self.changed_version = {}
+        self.status = {
+            "volume": "50",
+            "repeat": "0",
+            "random": "0",
+            "single": "0",
+            "consume": "0",
+            "state": "stop",
+        }
+        self.current = None
+        self.elapsed = 0.0
+        self.outputs = [
+            {
+                "outputid": "0",
+                "outputname": "Speakers",
+                "plugin": "alsa",
+                "outputenabled": "1",
+            },
+            {
+                "outputid": "1",
+                "outputname": "Stream",
+                "plugin": "httpd",
+                "outputenabled": "0",
+            },
+        ]
+        self.playlists = playlists or {}
+        self.db_update = int(time.time())
+        self.started = time.time()
+        self.listeners = []
+        self.commands = 0
+        self.roundtrips = 0
+        self.command_counts = {}
+
+    # Idle notification ///////////////////////////////////////////////////
+    def notify(self, *subsystems):
+        for listener in list(self.listeners):
+            listener.notify(subsystems)
+
+    # Queue helpers ///////////////////////////////////////////////////////
+    def _changed_since(self, song, version):
+        return self.changed_version.get(song["Id"], 0) > version
+
+    def _touch(self, *positions):
+        self.playlist_version += 1
+        for pos in positions:
+            if 0 <= pos < len(self.queue):
+                self.changed_version[self.queue[pos]["Id"]] = self.playlist_version
+        self.notify("playlist")
+
+    def _renumber(self, start=0):
+        for pos in range(start, len(self.queue)):
+            if self.queue[pos].get("Pos") != str(pos):
+                self.queue[pos]["Pos"] = str(pos)
+                self.changed_version[self.queue[pos]["Id"]] = self.playlist_version + 1
+
+    def _insert(self, files, pos=None):
+        if pos is None:
+            pos = len(self.queue)
+        entries = []
+        for file in files:
+            song = self.by_file.get(file)
+            if song is None:
+                raise MPDError(50, "No such song")
+            entry = dict(song)
+            entry["Id"] = str(self.next_id)
+            self.next_id += 1
+            entries.append(entry)
+        self.queue[pos:pos] = entries
+        for entry in entries:
+            self.changed_version[entry["Id"]] = self.playlist_version + 1
+        self._renumber(pos)
+        self._touch()
+        return entries
+
+    def _delete(self, start, end):
+        if start < 0 or end > len(self.queue) or start >= end:
+            raise MPDError(2, "Bad song index")
+        current_id = self.current["Id"] if self.current else None
+        del self.queue[start:end]
+        self._renumber(start)
+        self._touch()
+        if current_id and not any(s["Id"] == current_id for s in self.queue):
+            self.current = None
+            self.status["state"] = "stop"
+            self.notify("player")
+
+    def _resolve_position(self, arg):
+        if arg.startswith(("+", "-")):
+            if self.current is None:
+                raise MPDError(2, "No current song")
+            offset = int(arg[1:])
+            cur = int(self.current["Pos"])
+            return cur + 1 + offset if arg[0] == "+" else cur - offset
+        return int(arg)
+
+    def _play(self, pos):
+        if not 0 <= pos < len(self.queue):
+            raise MPDError(2, "Bad song index")
+        self.current = self.queue[pos]
+        self.status["state"] = "play"
+        self.elapsed = 0.0
+        self.notify("player")
+
+    # Commands ////////////////////////////////////////////////////////////
+    def cmd_ping(self, args):
+        return []
+
+    def cmd_binarylimit(self, args):
+        return []
+
+    def cmd_status(self, args):
+        status = dict(self.status)
+        status["playlist"] = str(self.playlist_version)
+        status["playlistlength"] = str(len(self.queue))
+        if self.current is not None:
+            status["song"] = self.current["Pos"]
+            status["songid"] = self.current["Id"]
+            status["elapsed"] = f"{self.elapsed:.3f}"
+            status["duration"] = self.current["duration"]
+        return list(status.items())
+
+    def cmd_stats(self, args):
+        artists = {s["Artist"] for s in self.library}
+        albums = {s["Album"] for s in self.library}
+        return [
+            ("uptime", str(int(time.time() - self.started))),
+            ("playtime", "0"),
+            ("artists", str(len(artists))),
+            ("albums", str(len(albums))),
+            ("songs", str(len(self.library))),
+            ("db_playtime", str(int(sum(float(s["duration"]) for s in self.library)))),
+            ("db_update", str(self.db_update)),
+        ]
+
+    def cmd_currentsong(self, args):
+        return list(self.current.items()) if self.current else []
+
+    def cmd_outputs(self, args):
+        return [pair for output in self.outputs for pair in output.items()]
+
+    def cmd_enableoutput(self, args, enabled="1"):
+        for output in self.outputs:
+            if output["outputid"] == args[0]:
+                output["outputenabled"] = enabled
+        self.notify("output")
+        return []
+
+    def cmd_disableoutput(self, args):
+        return self.cmd_enableoutput(args, "0")
+
+    def cmd_playlistinfo(self, args):
+        songs = self.queue
+        if args:
+            start, end = parse_range(args[0], len(self.queue))
+            if start >= len(self.queue):
+                raise MPDError(2, "Bad song index")
+            songs = self.queue[start:end]
+        return [pair for song in songs for pair in song.items()]
+
+    def cmd_playlistid(self, args):
+        songs = [s for s in self.queue if not args or s["Id"] == args[0]]
+        return [pair for song in songs for pair in song.items()]
+
+    def cmd_playlist(self, args):
+        return [(str(i), "file: " + s["file"]) for i, s in enumerate(self.queue)]
+
+    def cmd_plchanges(self, args):
+        version = int(args[0])
+        songs = [s for s in self.queue if self._changed_since(s, version)]
+        return [pair for song in songs for pair in song.items()]
+
+    def cmd_plchangesposid(self, args):
+        version = int(args[0])
+        songs = [s for s in self.queue if self._changed_since(s, version)]
+        return [pair for s in songs for pair in (("cpos", s["Pos"]), ("Id", s["Id"]))]
+
+    def cmd_playlistfind(self, args, exact=True):
+        check, _ = parse_filter(args, exact=exact)
+        return [pair for song in self.queue if check(song) for pair in song.items()]
+
+    def cmd_playlistsearch(self, args):
+        return self.cmd_playlistfind(args, exact=False)
+
+    def _find(self, args, exact):
+        check, rest = parse_filter(args, exact=exact)
+        songs = [s for s in self.library if check(s)]
+        position = None
+        while rest:
+            option = rest[0].lower()
+            if option == "window":
+                start, end = parse_range(rest[1], len(songs))
+                songs = songs[start:end]
+            elif option == "sort":
+                key = rest[1].lstrip("-")
+                songs = sorted(songs, key=lambda s: tag_value(s, key))
+                if rest[1].startswith("-"):
+                    songs.reverse()
+            elif option == "position":
+                position = rest[1]
+            else:
+                raise MPDError(2, f"Unknown option {rest[0]}")
+            rest = rest[2:]
+        return songs, position
+
+    def cmd_find(self, args):
+        songs, _ = self._find(args, exact=True)
+        return [pair for song in songs for pair in song.items()]
+
+    def cmd_search(self, args):
+        songs, _ = self._find(args, exact=False)
+        return [pair for song in songs for pair in song.items()]
+
+    def cmd_findadd(self, args, exact=True):
+        songs, position = self._find(args, exact=exact)
+        pos = None if position is None else self._resolve_position(position)
+        self._insert([s["file"] for s in songs], pos)
+        return []
+
+    def cmd_searchadd(self, args):
+        return self.cmd_findadd(args, exact=False)
+
+    def cmd_count(self, args):
+        group = None
+        if "group" in args:
+            index = args.index("group")
+            group = args[index + 1]
+            args = args[:index]
+        check, _ = parse_filter(args)
+        songs = [s for s in self.library if check(s)]
+        if group is None:
+            return [
+                ("songs", str(len(songs))),
+                ("playtime", str(int(sum(float(s["duration"]) for s in songs)))),
+            ]
+        groups = {}
+        for song in songs:
+            groups.setdefault(tag_value(song, group), []).append(song)
+        result = []
+        for name, members in sorted(groups.items()):
+            result += [
+                (group, name),
+                ("songs", str(len(members))),
+                ("playtime", str(int(sum(float(s["duration"]) for s in members)))),
+            ]
+        return result
+
+    def cmd_list(self, args):
+        tag = args[0]
+        args = args[1:]
+        groups = []
+        if len(args) == 1 and not args[0].startswith("("):
+            # Legacy "list album ARTIST" form
+            args = ["artist", args[0]]
+        check, rest = parse_filter(args)
+        while rest:
+            if rest[0].lower() == "group":
+                groups.append(rest[1])
+            rest = rest[2:]
+
+        seen = set()
+        rows = []
+        for song in self.library:
+            if not check(song):
+                continue
+            key = tuple(tag_value(song, g) for g in groups) + (tag_value(song, tag),)
+            if key not in seen:
+                seen.add(key)
+                rows.append(key)
+        rows.sort()
+        tag_name = "file" if tag.lower() == "file" else tag.title()
+        names = [g.title() for g in groups] + [tag_name]
+        result = []
+        last = [None] * len(groups)
+        for row in rows:
+            for i, name in enumerate(names[:-1]):
+                if row[i] != last[i]:
+                    result.append((name, row[i]))
+                    last[i] = row[i]
+                    last[i + 1 :] = [None] * (len(groups) - i - 1)
+            result.append((names[-1], row[-1]))
+        return result
+
+    def cmd_listallinfo(self, args):
+        return [pair for song in self.library for pair in song.items()]
+
+    def cmd_listall(self, args):
+        return [("file", song["file"]) for song in self.library]
+
+    def cmd_listplaylists(self, args):
+        return [
+            pair
+            for name in sorted(self.playlists)
+            for pair in (("playlist", name), ("Last-Modified", "2024-01-01T00:00:00Z"))
+        ]
+
+    def _playlist(self, name):
+        if name not in self.playlists:
+            raise MPDError(50, "No such playlist")
+        return self.playlists[name]
+
+    def cmd_listplaylist(self, args):
+        return [("file", f) for f in self._playlist(args[0])]
+
+    def cmd_listplaylistinfo(self, args):
+        songs = [self.by_file[f] for f in self._playlist(args[0])]
+        return [pair for song in songs for pair in song.items()]
+
+    def cmd_load(self, args):
+        files = self._playlist(args[0])
+        pos = None
+        if len(args) > 1:
+            start, end = parse_range(args[1], len(files))
+            files = files[start:end]
+        if len(args) > 2:
+            pos = self._resolve_position(args[2])
+        self._insert(files, pos)
+        return []
+
+    def cmd_rm(self, args):
+        self._playlist(args[0])
+        del self.playlists[args[0]]
+        self.notify("stored_playlist")
+        return []
+
+    def cmd_save(self, args):
+        self.playlists[args[0]] = [s["file"] for s in self.queue]
+        self.notify("stored_playlist")
+        return []
+
+    def cmd_add(self, args):
+        if args[0] in self.by_file:
+            files = [args[0]]
+        else:
+            prefix = args[0].rstrip("/") + "/"
+            files = [s["file"] for s in self.library if s["file"].startswith(prefix)]
+            if not files:
+                raise MPDError(50, "No such directory")
+        pos = self._resolve_position(args[1]) if len(args) > 1 else None
+        self._insert(files, pos)
+        return []
+
+    def cmd_addid(self, args):
+        pos = self._resolve_position(args[1]) if len(args) > 1 else None
+        if pos is not None and not 0 <= pos <= len(self.queue):
+            raise MPDError(2, "Bad song index")
+        entry = self._insert([args[0]], pos)[0]
+        return [("Id", entry["Id"])]
+
+    def cmd_delete(self, args):
+        start, end = parse_range(args[0], len(self.queue))
+        self._delete(start, min(end, len(self.queue)))
+        return []
+
+    def cmd_deleteid(self, args):
+        for pos, song in enumerate(self.queue):
+            if song["Id"] == args[0]:
+                self._delete(pos, pos + 1)
+                return []
+        raise MPDError(50, "No such song")
+
+    def _move(self, start, end, to):
+        if start < 0 or end > len(self.queue) or start >= end:
+            raise MPDError(2, "Bad song index")
+        songs = self.queue[start:end]
+        del self.queue[start:end]
+        if not 0 <= to <= len(self.queue):
+            self.queue[start:start] = songs
+            raise MPDError(2, "Bad song index")
+        self.queue[to:to] = songs
+        self._renumber(0)
+        self._touch()
+
+    def cmd_move(self, args):
+        start, end = parse_range(args[0], len(self.queue))
+        self._move(start, end, self._resolve_position(args[1]))
+        return []
+
+    def cmd_moveid(self, args):
+        for pos, song in enumerate(self.queue):
+            if song["Id"] == args[0]:
+                self._move(pos, pos + 1, self._resolve_position(args[1]))
+                return []
+        raise MPDError(50, "No such song")
+
+    def cmd_clear(self, args):
+        self.queue = []
+        self.current = None
+        self.status["state"] = "stop"
+        self._touch()
+        return []
+
+    def cmd_shuffle(self, args):
+        random.shuffle(self.queue)
+        self._renumber(0)
+        self._touch()
+        return []
+
+    def cmd_play(self, args):
+        self._play(int(args[0]) if args else 0)
+        return []
+
+    def cmd_playid(self, args):
+        for pos, song in enumerate(self.queue):
+            if song["Id"] == args[0]:
+                self._play(pos)
+                return []
+        raise MPDError(50, "No such song")
+
+    def cmd_pause(self, args):
+        if self.status["state"] == "play":
+            self.status["state"] = "pause"
+        elif self.status["state"] == "pause":
+            self.status["state"] = "play"
+        self.notify("player")
+        return []
+
+    def cmd_stop(self, args):
+        self.status["state"] = "stop"
+        self.notify("player")
+        return []
+
+    def _step(self, offset):
+        if self.current is None:
+            raise MPDError(55, "Not playing")
+        pos = int(self.current["Pos"]) + offset
+        if 0 <= pos < len(self.queue):
+            self._play(pos)
+        else:
+            self.current = None
+            self.status["state"] = "stop"
+            self.notify("player")
+
+    def cmd_next(self, args):
+        self._step(1)
+        return []
+
+    def cmd_previous(self, args):
+        self._step(-1)
+        return []
+
+    def cmd_seekcur(self, args):
+        self.elapsed = float(args[0])
+        self.notify("player")
+        return []
+
+    def cmd_setvol(self, args):
+        self.status["volume"] = str(max(0, min(100, int(args[0]))))
+        self.notify("mixer")
+        return []
+
+    def cmd_volume(self, args):
+        return self.cmd_setvol([int(self.status["volume"]) + int(args[0])])
+
+    def _option(self, name, args):
+        self.status[name] = args[0]
+        self.notify("options")
+        return []
+
+    def cmd_random(self, args):
+        return self._option("random", args)
+
+    def cmd_repeat(self, args):
+        return self._option("repeat", args)
+
+    def cmd_single(self, args):
+        return self._option("single", args)
+
+    def cmd_consume(self, args):
+        return self._option("consume", args)
+
+    def cmd_update(self, args):
+        self.db_update = int(time.time())
+        self.notify("update", "database")
+        return [("updating_db", "1")]
+
+    def art(self, file):
+        song = self.by_file.get(file)
+        if song is None or not self.art_size:
+            raise MPDError(50, "No file exists")
+        blob = self.art_blobs.get(song["Album"])
+        if blob is None:
+            seed = hashlib.sha256(song["Album"].encode()).digest()
+            blob = self.art_blobs[song["Album"]] = make_art(seed, self.art_size)
+        return blob
+
+    def cmd_readpicture(self, args):
+        blob = self.art(args[0])
+        offset = int(args[1])
+        chunk = blob[offset : offset + BINARY_LIMIT]
+        return [("size", str(len(blob))), ("type", "image/jpeg"), ("binary", chunk)]
+
+    def cmd_albumart(self, args):
+        blob = self.art(args[0])
+        offset = int(args[1])
+        chunk = blob[offset : offset + BINARY_LIMIT]
+        return [("size", str(len(blob))), ("binary", chunk)]
+
+    def execute(self, line):
+        args = unquote_args(line)
+        command = args[0]
+        func = getattr(self, f"cmd_{command}", None)
+        with self.lock:
+            self.commands += 1
+            self.command_counts[command] = self.command_counts.get(command, 0) + 1
+            if func is None:
+                raise MPDError(5, f'unknown command "{command}"')
+            return func(args[1:])
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.pending = set()
+        self.condition = threading.Condition()
+
+    def notify(self, subsystems):
+        with self.condition:
+            self.pending.update(subsystems)
+            self.condition.notify_all()
+
+    def write_pairs(self, pairs):
+        out = bytearray()
+        for key, value in pairs:
+            if key == "binary":
+                out += f"binary: {len(value)}\n".encode() + value + b"\n"
+            elif key.isdigit():
+                out += f"{key}:{value}\n".encode()
+            else:
+                out += f"{key}: {value}\n".encode()
+        return bytes(out)
+
+    def idle(self, args):
+        wanted = set(args) or set(SUBSYSTEMS)
+        while True:
+            with self.condition:
+                ready = self.pending & wanted
+                if ready:
+                    self.pending -= ready
+                    return [("changed", s) for s in sorted(ready)]
+                self.condition.wait(0.05)
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if not readable:
+                continue
+            line = self.rfile.readline()
+            if not line:
+                raise ConnectionError
+            if line.strip() == b"noidle":
+                with self.condition:
+                    ready = self.pending & wanted
+                    self.pending -= ready
+                return [("changed", s) for s in sorted(ready)]
+
+    def handle(self):
+        server = self.server.mpd
+        server.listeners.append(self)
+        self.wfile.write(f"OK MPD {MPD_VERSION}\n".encode())
+        command_list = None
+        list_ok = False
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                line = line.decode("utf-8").rstrip("\n")
+                if line in ("command_list_begin", "command_list_ok_begin"):
+                    command_list = []
+                    list_ok = line == "command_list_ok_begin"
+                    continue
+                if command_list is not None and line != "command_list_end":
+                    command_list.append(line)
+                    continue
+                if line == "close":
+                    break
+                if line == "noidle":
+                    continue
+
+                lines = [line] if command_list is None else command_list
+                # Idling isn't work done for a request
+                if not lines[0].startswith("idle"):
+                    server.roundtrips += 1
+                out = bytearray()
+                try:
+                    for index, cmd in enumerate(lines):
+                        if cmd.startswith("idle"):
+                            pairs = self.idle(unquote_args(cmd)[1:])
+                        else:
+                            pairs = server.execute(cmd)
+                        out += self.write_pairs(pairs)
+                        if command_list is not None and list_ok:
+                            out += b"list_OK\n"
+                    out += b"OK\n"
+                except (MPDError, ValueError, IndexError, KeyError) as e:
+                    if not isinstance(e, MPDError):
+                        e = MPDError(2, f"Bad arguments: {e}")
+                    name = unquote_args(cmd)[0] if cmd else ""
+                    out += f"ACK [{e.code}@{index}] {{{name}}} {e.msg}\n".encode()
+                except ConnectionError:
+                    break
+                command_list = None
+                self.wfile.write(bytes(out))
+        finally:
+            server.listeners.remove(self)
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, mpd):
+        self.mpd = mpd
+        super().__init__(address, Handler)
+
+
+def serve(host="127.0.0.1", port=0, songs=10000, art_size=200000, playlists=0):
+    library = make_library(songs)
+    stored = {}
+    rng = random.Random(2)
+    for i in range(playlists):
+        stored[f"Playlist {i}"] = [s["file"] for s in rng.sample(library, 50)]
+    mpd = FakeMPD(library, art_size=art_size, playlists=stored)
+    server = Server((host, port), mpd)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fake MPD server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6600)
+    parser.add_argument("--songs", type=int, default=10000)
+    parser.add_argument("--art-size", type=int, default=200000)
+    parser.add_argument("--playlists", type=int, default=5)
+    args = parser.parse_args()
+
+    server = serve(args.host, args.port, args.songs, args.art_size, args.playlists)
+    print(f"Fake MPD listening on {args.host}:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
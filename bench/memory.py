@@ -0,0 +1,90 @@
+# Measures the memory the indexed library takes, as a dict per song and as
+# wempd's columnar LibraryStore, both filled from listallinfo on the fake
+# MPD server so every string is parsed like it would be from a real one. The
+# server runs as a subprocess so that only the client side is measured.
+#
+#   python bench/memory.py --songs 300000
+import argparse
+import gc
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import mpd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT)
+
+from library import SONG_KEYS  # noqa: E402
+from store import LibraryStore  # noqa: E402
+
+
+def as_dicts(client):
+    return [
+        {k: v for k, v in song.items() if k in SONG_KEYS}
+        for song in client.listallinfo()
+        if "file" in song
+    ]
+
+
+def as_store(client):
+    songs = LibraryStore(SONG_KEYS)
+    for song in client.listallinfo():
+        if "file" in song:
+            songs.append(song)
+    songs.finish()
+    return songs
+
+
+def measure(port, build):
+    client = mpd.MPDClient()
+    client.iterate = True
+    client.connect("127.0.0.1", port)
+    try:
+        gc.collect()
+        tracemalloc.start()
+        started = time.perf_counter()
+        songs = build(client)
+        seconds = time.perf_counter() - started
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        client.disconnect()
+    return songs, retained, peak, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure library memory")
+    parser.add_argument("--songs", type=int, default=100000)
+    args = parser.parse_args()
+
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "fakempd.py"), "--port", "0"]
+        + ["--songs", str(args.songs), "--playlists", "0"],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    port = int(server.stdout.readline().rsplit(":", 1)[1])
+
+    print(
+        f"{'':10} {'songs':>8} {'retained':>12} {'per song':>9} {'peak':>12} "
+        f"{'build':>8}"
+    )
+    for name, build in (("dicts", as_dicts), ("store", as_store)):
+        songs, retained, peak, seconds = measure(port, build)
+        print(
+            f"{name:10} {len(songs):8} {retained:12,} {retained // len(songs):9,} "
+            f"{peak:12,} {seconds:7.2f}s"
+        )
+        del songs
+
+    server.terminate()
+    server.wait()
+
+
+if __name__ == "__main__":
+    main()
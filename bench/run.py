@@ -0,0 +1,443 @@
+# Benchmarks every wempd route against the fake MPD server.
+#
+#   python bench/run.py --songs 10000 --output results.json
+#   python bench/run.py --compare before.json --output after.json
+#
+# wempd runs as a subprocess, as it would normally. Each route reports its
+# latency, the MPD round trips and commands it caused, and the bytes sent.
+import argparse
+import http.client
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fakempd  # noqa: E402
+
+PREFIX = "/mpd"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def q(value):
+    return urllib.parse.quote_plus(value)
+
+
+def reset_queue(client, library):
+    # The same queue for every route, a few albums with the first playing
+    client.request("POST", "/api/clear")
+    for song in library[: 50 : 10]:
+        client.request("POST", "/api/append", {"album": song["Album"]})
+    client.request("POST", "/api/play", {"id": 0})
+    client.request("POST", "/api/pause")
+
+
+def build_cases(library, playlist):
+    song = library[0]
+    artist = song["AlbumArtist"]
+    album = song["Album"]
+    file = song["file"]
+    genre = song["Genre"].split(";")[0]
+    year = song["OriginalDate"][:4]
+    label = song["Label"]
+    decade = f"{year[:3]}0s"
+    fill = [("POST", "/api/append", {"album": album})]
+
+    def get(path, **extra):
+        return {"method": "GET", "path": path, **extra}
+
+    def post(path, body=None, setup=(), **extra):
+        return {
+            "method": "POST",
+            "path": path,
+            "body": body or {},
+            "setup": list(setup),
+            **extra,
+        }
+
+    return [
+        # API, GET
+        get("/api/albumartists"),
+        get(f"/api/albums?albumartist={q(artist)}"),
+        get("/api/albums?offset=0&limit=100"),
+        get(f"/api/art?file={q(file)}"),
+        get(f"/api/art?file={q(file)}&size=256"),
+        get("/api/artists"),
+        get(f"/api/count?album={q(album)}"),
+        get("/api/events", stream=True),
+        get("/api/facets?facet=genre"),
+        get(f"/api/facets?facet=genre&value={q(genre)}&limit=100"),
+        get(f"/api/info?file={q(file)}"),
+        get("/api/info?pos=0"),
+        get("/api/outputs"),
+        get("/api/playlists"),
+        get("/api/queue"),
+        get("/api/queue?version=0"),
+        get("/api/search?query=blue+rain"),
+        get("/api/search?query=blue+rain&stream=1"),
+        get("/api/stats"),
+        get("/api/status"),
+        get("/api/status?version=0"),
+        get("/api/titles"),
+        get("/api/titles?offset=0&limit=100"),
+        get(f"/api/titles?album={q(album)}"),
+        get(f"/api/titles?playlist={q(playlist)}"),
+        # API, POST
+        post("/api/add", {"entry": file}),
+        post("/api/append", {"album": album}),
+        post(
+            "/api/batch",
+            {
+                "ops": [
+                    {"op": "move", "from": [0, 2], "to": 3},
+                    {"op": "delete", "from": 0, "to": 2},
+                    {"op": "play", "pos": 0},
+                ],
+                "version": 0,
+            },
+            setup=fill,
+        ),
+        post("/api/clear", setup=fill),
+        post("/api/consume", {"enabled": "0"}),
+        post("/api/delete", {"from": 0, "to": 5}, setup=fill),
+        post("/api/disableoutput", {"outputid": 1}),
+        post("/api/enableoutput", {"outputid": 1}),
+        post("/api/insert", {"album": album}),
+        post("/api/insert", {"facet": "label", "value": label}),
+        post("/api/insert", {"playlist": playlist}),
+        post("/api/move", {"from": 0, "to": 1}, setup=fill),
+        post("/api/next", setup=fill + [("POST", "/api/play", {"id": 0})]),
+        post("/api/pause", setup=fill),
+        post("/api/play", {"id": 0}, setup=fill),
+        post("/api/prev", setup=fill + [("POST", "/api/play", {"id": 1})]),
+        post("/api/random", {"enabled": "0"}),
+        post("/api/remove", {"album": album}, setup=fill),
+        post("/api/remove", {"ids": [0, 1, 2]}, setup=fill),
+        post(
+            "/api/removeplaylist",
+            {"playlist": "bench"},
+            setup=fill + [("POST", "/api/save", {"name": "bench"})],
+        ),
+        post("/api/repeat", {"enabled": "0"}),
+        post(
+            "/api/save",
+            {"name": "bench"},
+            setup=[("POST", "/api/removeplaylist", {"playlist": "bench"})],
+        ),
+        post(
+            "/api/seek",
+            {"time": 10},
+            setup=fill + [("POST", "/api/play", {"id": 0})],
+        ),
+        post("/api/shuffle", setup=fill),
+        post("/api/single", {"enabled": "0"}),
+        post("/api/stop"),
+        post("/api/update"),
+        post("/api/volume", {"setvol": 50}),
+        # HTML
+        get("/status"),
+        get("/status/"),
+        get("/stats"),
+        get("/stats/"),
+        get("/current"),
+        get("/current/"),
+        get("/queue"),
+        get("/queue/"),
+        get("/queue/0"),
+        get("/outputs"),
+        get("/outputs/"),
+        get("/search?s=blue+rain"),
+        get("/search/"),
+        get("/playlists"),
+        get("/playlists/"),
+        get(f"/playlists/{q(playlist)}"),
+        get(f"/playlists/{q(playlist)}/"),
+        get(f"/playlists/{q(playlist)}/{q(file)}"),
+        get("/artists"),
+        get("/artists/"),
+        get("/albumartists/"),
+        get(f"/artists/{q(artist)}"),
+        get(f"/artists/{q(artist)}/"),
+        get(f"/artists/{q(artist)}/_all/"),
+        get(f"/artists/{q(artist)}/{q(album)}"),
+        get(f"/artists/{q(artist)}/{q(album)}/"),
+        get(f"/artists/{q(artist)}/{q(album)}/{q(file)}"),
+        get("/albums"),
+        get("/albums/"),
+        get("/albums/?offset=0&limit=100"),
+        get(f"/albums/{q(album)}"),
+        get(f"/albums/{q(album)}/"),
+        get("/albums/_random/"),
+        get(f"/albums/{q(album)}/{q(file)}"),
+        get("/genres"),
+        get("/genres/"),
+        get(f"/genres/{q(genre)}"),
+        get(f"/genres/{q(genre)}/"),
+        get("/dates"),
+        get("/dates/"),
+        get(f"/dates/{year}/"),
+        get(f"/dates/{decade}/"),
+        get("/labels"),
+        get("/labels/"),
+        get(f"/labels/{q(label)}/"),
+        get(f"/file/{q(file)}"),
+    ]
+
+
+def coverage(cases):
+    # Route patterns no case exercises, so new routes don't go unmeasured
+    sys.path.insert(0, ROOT)
+    import html
+    import wempd
+
+    covered = set()
+    for case in cases:
+        path = urllib.parse.urlsplit(case["path"]).path
+        if path.startswith("/api/"):
+            route, _ = wempd.api_routes.match(path.removeprefix("/api"))
+        else:
+            route, _ = html.router.match(path)
+        covered.add(route)
+
+    routes = [("api", r) for r in wempd.api_routes.routes]
+    routes += [("html", r) for r in html.router.routes]
+    return [f"{kind} {r.pattern}" for kind, r in routes if r not in covered]
+
+
+class Client:
+    def __init__(self, port, accept_encoding, keep_alive=False):
+        self.port = port
+        self.accept_encoding = accept_encoding
+        # One connection for every request, rather than one each
+        self.keep_alive = keep_alive
+        self.conn = None
+
+    def request(self, method, path, body=None, stream=False):
+        # Returns (status, bytes received), status is None if wempd hung up
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        headers = {"Accept-Encoding": self.accept_encoding}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        keep = False
+        try:
+            self.conn.request(method, PREFIX + path, body=data, headers=headers)
+            resp = self.conn.getresponse()
+            if stream:
+                return resp.status, 0
+            size = len(resp.read())
+            keep = self.keep_alive and not resp.will_close
+            return resp.status, size
+        except (OSError, http.client.HTTPException):
+            return None, 0
+        finally:
+            if not keep:
+                self.conn.close()
+                self.conn = None
+
+
+def summarize(times):
+    times = sorted(times)
+    return {
+        "min": round(times[0], 3),
+        "median": round(statistics.median(times), 3),
+        "p95": round(times[min(len(times) - 1, int(len(times) * 0.95))], 3),
+        "mean": round(statistics.fmean(times), 3),
+    }
+
+
+def measure(client, mpd, case, iterations):
+    latencies = []
+    roundtrips = []
+    commands = {}
+    sizes = []
+    status = None
+    for _ in range(iterations):
+        for method, path, body in case.get("setup", []):
+            client.request(method, path, body)
+
+        before_trips = mpd.roundtrips
+        before_commands = dict(mpd.command_counts)
+        started = time.perf_counter()
+        status, size = client.request(
+            case["method"], case["path"], case.get("body"), case.get("stream", False)
+        )
+        latencies.append((time.perf_counter() - started) * 1000)
+        roundtrips.append(mpd.roundtrips - before_trips)
+        sizes.append(size)
+        for command, count in mpd.command_counts.items():
+            delta = count - before_commands.get(command, 0)
+            if delta:
+                commands[command] = commands.get(command, 0) + delta
+
+    name = f"{case['method']} {case['path']}"
+    if case.get("body"):
+        name += " " + json.dumps(case["body"], sort_keys=True)
+    result = {
+        "name": name,
+        "status": status,
+        "latency_ms": summarize(latencies),
+        "roundtrips": round(statistics.fmean(roundtrips), 2),
+        "commands": {k: round(v / iterations, 2) for k, v in sorted(commands.items())},
+        "bytes": round(statistics.fmean(sizes)),
+    }
+    result["latency_ms"]["first"] = round(latencies[0], 3)
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def wait_ready(client, timeout):
+    # Until the library indexes are built, so they are measured rather than
+    # the fallbacks.
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", client.port, timeout=5)
+            conn.request("GET", PREFIX + "/api/stats")
+            stats = json.loads(conn.getresponse().read())
+            conn.close()
+            if stats.get("library", {}).get("indexes"):
+                return True
+        except (OSError, ValueError, http.client.HTTPException):
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def compare(old, new):
+    old = {r["name"]: r for r in old["results"]}
+    print(f"{'route':60} {'median ms':>19} {'round trips':>13} {'bytes':>19}")
+    for r in new["results"]:
+        o = old.get(r["name"])
+        if o is None:
+            continue
+        print(
+            f"{r['name'][:60]:60}"
+            f" {o['latency_ms']['median']:>9.2f} {r['latency_ms']['median']:>9.2f}"
+            f" {o['roundtrips']:>6g} {r['roundtrips']:>6g}"
+            f" {o['bytes']:>9} {r['bytes']:>9}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark wempd routes")
+    parser.add_argument("--songs", type=int, default=10000)
+    parser.add_argument("--art-size", type=int, default=200000)
+    parser.add_argument("--playlists", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--accept-encoding", default="gzip")
+    parser.add_argument(
+        "--keep-alive", action="store_true", help="reuse one HTTP connection"
+    )
+    parser.add_argument("--filter", help="only routes containing this")
+    parser.add_argument("--output", help="write results here as JSON")
+    parser.add_argument("--compare", help="results JSON to compare against")
+    parser.add_argument("--python", default=sys.executable)
+    args = parser.parse_args()
+
+    server = fakempd.serve(
+        songs=args.songs, art_size=args.art_size, playlists=args.playlists
+    )
+    mpd = server.mpd
+    port = free_port()
+    cache_dir = tempfile.mkdtemp(prefix="wempd-bench-")
+    env = dict(
+        os.environ,
+        WEMPD_MPD_HOST="127.0.0.1",
+        WEMPD_MPD_PORT=str(server.server_address[1]),
+        WEMPD_LISTEN_ADDRESS="127.0.0.1",
+        WEMPD_LISTEN_PORT=str(port),
+        WEMPD_ART_CACHE_DIR=cache_dir,
+    )
+    os.environ["WEMPD_ART_CACHE_DIR"] = cache_dir
+
+    cases = build_cases(mpd.library, sorted(mpd.playlists)[0])
+    uncovered = coverage(cases)
+    for route in uncovered:
+        print(f"Warning: no benchmark for {route}", file=sys.stderr)
+    if args.filter:
+        cases = [c for c in cases if args.filter in c["path"]]
+
+    proc = subprocess.Popen(
+        [args.python, os.path.join(ROOT, "wempd.py")],
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        client = Client(port, args.accept_encoding, args.keep_alive)
+        started = time.monotonic()
+        if not wait_ready(client, timeout=max(60, args.songs / 1000)):
+            sys.exit("wempd did not become ready")
+        ready_seconds = time.monotonic() - started
+
+        results = []
+        for case in cases:
+            reset_queue(client, mpd.library)
+            result = measure(client, mpd, case, args.iterations)
+            results.append(result)
+            print(
+                f"{result['name'][:70]:70} {result['status']}"
+                f" {result['latency_ms']['median']:8.2f} ms"
+                f" {result['roundtrips']:6g} trips {result['bytes']:9} B",
+                file=sys.stderr,
+            )
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "songs": args.songs,
+            "art_size": args.art_size,
+            "iterations": args.iterations,
+            "accept_encoding": args.accept_encoding,
+            "keep_alive": args.keep_alive,
+            "ready_seconds": round(ready_seconds, 3),
+        },
+        "uncovered": uncovered,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import collections
+import functools
+import os
+import threading
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return frozenset((k, freeze(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+class LibraryCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        # The MPD db_update timestamp, None until the idle watcher has told us
+        # so nothing is cached that couldn't be invalidated.
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def set_version(self, version):
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.entries.clear()
+                self.invalidations += 1
+
+    def on_database(self, changed, client):
+        self.set_version(client.stats().get("db_update"))
+
+    def get(self, key, func):
+        with self.lock:
+            version = self.version
+            if version is not None and key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        value = func()
+
+        with self.lock:
+            if version is not None and version == self.version:
+                self.entries[key] = value
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return value
+
+    def cached(self, func):
+        # Results are shared between requests, callers must not modify them.
+        @functools.wraps(func)
+        def wrapper(client, *args):
+            key = (func.__name__, *(freeze(a) for a in args))
+            return self.get(key, lambda: func(client, *args))
+
+        return wrapper
+
+    def stats(self):
+        with self.lock:
+            return {
+                "version": self.version,
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+
+class PageCache:
+    # Rendered pages that only depend on the database, max_bytes in all. The
+    # route holding the most gives up its least recently used page first, so
+    # one big page can't push out everything else.
+    def __init__(self, library, max_bytes):
+        self.library = library
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.version = None
+        # route -> OrderedDict of key -> (value, size)
+        self.routes = collections.defaultdict(collections.OrderedDict)
+        self.sizes = collections.Counter()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, route, key, func, size):
+        version = self.library.version
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.routes.clear()
+                self.sizes.clear()
+                self.total_bytes = 0
+            entries = self.routes[route]
+            if version is not None and key in entries:
+                entries.move_to_end(key)
+                self.hits += 1
+                return entries[key][0]
+            self.misses += 1
+
+        value = func()
+        nbytes = size(value)
+
+        with self.lock:
+            if version is None or version != self.version or nbytes > self.max_bytes:
+                return value
+            entries = self.routes[route]
+            if key not in entries:
+                entries[key] = (value, nbytes)
+                self.sizes[route] += nbytes
+                self.total_bytes += nbytes
+            while self.total_bytes > self.max_bytes:
+                largest = max(self.sizes, key=self.sizes.get)
+                _, (_, evicted) = self.routes[largest].popitem(last=False)
+                self.sizes[largest] -= evicted
+                self.total_bytes -= evicted
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {
+                "routes": len(self.routes),
+                "entries": sum(len(e) for e in self.routes.values()),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+library_cache = LibraryCache(int(os.getenv("WEMPD_LIBRARY_CACHE_ENTRIES", "256")))
+page_cache = PageCache(
+    library_cache, int(os.getenv("WEMPD_PAGE_CACHE_SIZE", "4")) * 1024 * 1024
+)
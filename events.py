@@ -0,0 +1,68 @@
+import json
+import queue
+import threading
+
+
+KEEPALIVE_INTERVAL = 15
+SEND_TIMEOUT = 5
+
+SUBSYSTEMS = ("player", "playlist", "mixer", "options", "database", "update", "output")
+
+
+class EventBroadcaster:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = []
+        self.messages = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="sse-broadcaster", daemon=True
+        )
+        self.thread.start()
+
+    def add(self, sock):
+        sock.settimeout(SEND_TIMEOUT)
+        with self.lock:
+            self.clients.append(sock)
+        # Make the browser reconnect quickly if we go away
+        self.messages.put((sock, b"retry: 2000\n\n"))
+
+    def on_idle(self, changed, client):
+        self.publish(changed)
+
+    def publish(self, changed):
+        message = "".join(
+            f"event: {subsystem}\ndata: {json.dumps(subsystem)}\n\n"
+            for subsystem in sorted(changed)
+        )
+        self.messages.put((None, message.encode("utf-8")))
+
+    def send(self, sock, data):
+        try:
+            sock.sendall(data)
+        except OSError:
+            with self.lock:
+                if sock in self.clients:
+                    self.clients.remove(sock)
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def run(self):
+        while True:
+            try:
+                target, data = self.messages.get(timeout=KEEPALIVE_INTERVAL)
+            except queue.Empty:
+                # Comments keep proxies from timing out and find dead clients
+                target, data = None, b": keepalive\n\n"
+
+            with self.lock:
+                clients = [target] if target is not None else list(self.clients)
+            for sock in clients:
+                self.send(sock, data)
+
+
+event_broadcaster = EventBroadcaster()
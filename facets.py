@@ -0,0 +1,113 @@
+import array
+import collections
+import re
+
+from api import add_files, find_add, insert_position
+from library import library_list, library_snapshot
+
+
+# Facet -> the tag it comes from
+FACET_TAGS = {
+    "genre": "genre",
+    "year": "originaldate",
+    "decade": "originaldate",
+    "label": "label",
+}
+FACETS = tuple(FACET_TAGS)
+
+
+def tag_values(song, tag):
+    value = song.get(tag, "")
+    return value if isinstance(value, list) else [value]
+
+
+def song_facets(song):
+    # (facet, value) pairs a song is listed under, "" when it has none
+    for value in tag_values(song, "genre"):
+        for genre in re.split(r"[;/]", value):
+            yield "genre", genre.strip()
+
+    year = tag_values(song, "originaldate")[0][:4]
+    yield "year", year
+    yield "decade", f"{year[:3]}0s" if year else ""
+
+    for label in tag_values(song, "label"):
+        yield "label", label
+
+
+def normalize(value):
+    return value.strip().casefold()
+
+
+class FacetIndex:
+    def __init__(self, songs):
+        self.library = songs
+        # facet -> normalized value -> rows of the songs in the library
+        self.rows = {
+            facet: collections.defaultdict(lambda: array.array("I"))
+            for facet in FACETS
+        }
+        # facet -> normalized value -> value as first seen
+        self.names = {facet: {} for facet in FACETS}
+        for row, song in enumerate(songs):
+            seen = set()
+            for facet, value in song_facets(song):
+                key = normalize(value)
+                if (facet, key) in seen:
+                    continue
+                seen.add((facet, key))
+                self.rows[facet][key].append(row)
+                self.names[facet].setdefault(key, value)
+
+    def values(self, facet):
+        # [(value, song count)] sorted by value
+        return sorted(
+            (self.names[facet][key], len(rows))
+            for key, rows in self.rows[facet].items()
+        )
+
+    def find(self, facet, value):
+        return [self.library[row] for row in self.rows[facet].get(normalize(value), ())]
+
+
+def facet_filter(facet, value):
+    # The MPD filter for a facet, for when the index isn't ready
+    tag = FACET_TAGS[facet]
+    if value == "":
+        return (tag, "")
+    if facet == "label":
+        return (tag, value)
+    if facet == "decade":
+        value = value[:3]
+    return (f"({tag} contains '{value}')",)
+
+
+def facet_values(client, facet):
+    # [(value, song count)], without counts when the index isn't ready
+    index = library_snapshot.get("facets")
+    if index is not None:
+        return index.values(facet)
+
+    values = set()
+    for entry in library_list(client, FACET_TAGS[facet]):
+        values.update(v for f, v in song_facets(entry) if f == facet)
+    return [(value, None) for value in sorted(values)]
+
+
+def find_facet(client, facet, value):
+    index = library_snapshot.get("facets")
+    if index is not None:
+        return index.find(facet, value)
+    return client.find(*facet_filter(facet, value))
+
+
+def insert_facet(client, facet, value, append=False):
+    index = library_snapshot.get("facets")
+    if index is None:
+        return find_add(client, facet_filter(facet, value), append)
+
+    files = [song["file"] for song in index.find(facet, value)]
+    return add_files(client, files, insert_position(client.status(), append))
+
+
+library_snapshot.register("facets", FacetIndex)
@@ -1,10 +1,17 @@
+import collections
 import json
 import os
-import random
-import re
 import time
 from urllib.parse import quote_plus, unquote_plus, urlencode
 
+from api import int_param, paginate
+from cache import freeze, page_cache
+from facets import facet_values, find_facet
+from library import library_find, library_list
+from router import Router
+from sampling import random_picks
+from search import search_library
+from state import player_state
 
 BASE_MUSIC_URL = os.getenv("WEMPD_BASE_MUSIC_URL", "/")
 
@@ -87,7 +94,7 @@ def get_header(client, path):
             else html_link(text, ("mpd", name), root=True, folder=folder)
         )
 
-    status = client.status()
+    status = player_state.current_status(client)
     play_state = "Pause" if status["state"] == "play" else "Play"
 
     return [
@@ -381,7 +388,7 @@ def fmt_date(ts):
 
 
 def url_status(*, client, path, query):
-    status = client.status()
+    status = player_state.current_status(client)
 
     def gen_mode_button(mode):
         enabled = status[mode] == "1"
@@ -403,7 +410,7 @@ def url_status(*, client, path, query):
         position = f"{fmt_time(float(status['elapsed']))}/{fmt_time(float(status['duration']))}"
     state = {"pause": "paused", "play": "playing", "stop": "stopped"}[status["state"]]
 
-    cur_song = client.currentsong()
+    cur_song = player_state.current_song(client)
     try:
         title = f"{get_title(cur_song)} ({cur_song["artist"]})"
     except KeyError:
@@ -447,7 +454,7 @@ def url_status(*, client, path, query):
                         if output["outputenabled"] == "1"
                         else output["outputname"]
                     )
-                    for output in client.outputs()
+                    for output in player_state.current_outputs(client)
                 ]
             ),
         ),
@@ -505,23 +512,23 @@ def url_outputs(*, client, path, query):
                     td(icon_tick if o["outputenabled"] == "1" else icon_cross),
                     td(toggle(o)),
                 )
-                for o in client.outputs()
+                for o in player_state.current_outputs(client)
             )
         ),
     ]
 
 
 def url_current(*, client, path, query):
-    return [h2("Current Song"), *song_info_table(client.currentsong())], get_refresh(
-        client.status()
-    )
+    state = player_state.get_status(client)
+    return [
+        h2("Current Song"),
+        *song_info_table(state["currentsong"]),
+    ], get_refresh(state["status"])
 
 
 def url_queue(*, client, path, query):
-    queue = client.playlistinfo()
-    status = client.status()
-    if "song" in status:
-        queue[int(status["song"])]["current"] = status["state"]
+    state = player_state.get_status(client)
+    queue, status = state["queue"], state["status"]
 
     items = []
     for index, song in enumerate(queue):
@@ -562,7 +569,7 @@ def url_queue_item(item, *, client, path, query):
             html_form_link("/mpd/api/remove", {"ids": [item]}, "Remove from queue"),
         ),
         *song_info_table(song_info),
-    ], get_refresh(client.status())
+    ], get_refresh(player_state.current_status(client))
 
 
 def url_search(*, client, path, query):
@@ -570,7 +577,10 @@ def url_search(*, client, path, query):
 
     thelist = []
     if query and len(query) >= 3:
-        for song in client.search("any", query):
+        songs = search_library(query)
+        if songs is None:
+            songs = client.search("any", query)
+        for song in songs:
             href = ("artists", song["artist"], song.get("album", ""), song["file"])
             thelist.append(
                 li(
@@ -621,7 +631,7 @@ def url_artists(style, *, client, path, query):
             li(em(html_link("Random", "_random"))),
             *(
                 li(html_link(a[artist_type], a[artist_type]))
-                for a in client.list(artist_type)
+                for a in library_list(client, artist_type)
             ),
         ),
     )
@@ -631,9 +641,12 @@ def url_artists_artist(style, artist, *, client, path, query):
     artist_type = f"{style}artist"
     is_random = artist == "_random"
     if is_random:
-        artist = random.choice(client.list(artist_type))[artist_type]
+        picks = random_picks(client, artist_type)
+        if not picks:
+            return [], {"location": "..", "code": 302}
+        artist = picks[0][artist_type]
 
-    albums = client.list("album", artist_type, artist, "group", "originaldate")
+    albums = library_list(client, "album", artist_type, artist, "group", "originaldate")
 
     if len(albums) == 1 and not is_random:
         return [], {"location": f"./{albums[0]['album']}/", "code": 302}
@@ -666,7 +679,8 @@ def url_artists_artist_all(style, artist, *, client, path, query):
     ]
     data = (artist_type, artist)
     thelist = [
-        li_artist_title(a) for a in sorted(client.find(*data), key=lambda x: x["title"])
+        li_artist_title(a)
+        for a in sorted(library_find(client, *data), key=lambda x: x["title"])
     ]
     return create_page(header, {"find": data}, ul(thelist))
 
@@ -682,7 +696,7 @@ def url_artists_artist_album(style, artist, album, *, client, path, query):
 
     data = (artist_type, artist, "album", None if all_tracks else album)
     songs = sorted(
-        client.find(*data),
+        library_find(client, *data),
         key=lambda a: a["track"].rjust(4) if "track" in a else a["title"],
     )
     if len(set(a["artist"] for a in songs)) == 1:
@@ -708,38 +722,56 @@ def url_artists_artist_album_track(style, artist, album, file, *, client, path,
     )
 
 
+def page_links(query, total):
+    offset = int_param(query, "offset")
+    limit = int_param(query, "limit")
+    if not limit:
+        return []
+
+    links = []
+    if offset > 0:
+        page = {"offset": max(0, offset - limit), "limit": limit}
+        links.append(a("Previous", href=esc("?" + urlencode(page))))
+    if offset + limit < total:
+        page = {"offset": offset + limit, "limit": limit}
+        links.append(a("Next", href=esc("?" + urlencode(page))))
+    return [p(" ".join(links))] if links else []
+
+
 def url_albums(*, client, path, query):
+    albums = sorted(
+        library_list(client, "album", "group", "albumartist"),
+        key=lambda x: x["album"],
+    )
     return create_page(
         "Albums",
         None,
-        ul(
-            li(em(html_link("Random", "_random"))),
-            *[
-                li(
-                    html_link(a["album"] if a["album"] else "none", a["album"]),
-                    " - ",
-                    a["albumartist"],
-                )
-                for a in sorted(
-                    client.list("album", "group", "albumartist"),
-                    key=lambda x: x["album"],
-                )
-            ],
-        ),
+        [
+            ul(
+                li(em(html_link("Random", "_random"))),
+                *[
+                    li(
+                        html_link(a["album"] if a["album"] else "none", a["album"]),
+                        " - ",
+                        a["albumartist"],
+                    )
+                    for a in paginate(albums, query)
+                ],
+            ),
+            *page_links(query, len(albums)),
+        ],
     )
 
 
-_album_list = []
 def url_albums_album(album, *, client, path, query):
-    is_random = album == "_random"
-    if is_random:
-        global _album_list
-        if len(_album_list) == 0:
-            _album_list = client.list("album")
-        album = random.choice(_album_list)["album"]
+    if album == "_random":
+        picks = random_picks(client, "album")
+        if not picks:
+            return [], {"location": "..", "code": 302}
+        album = picks[0]["album"]
 
     data = ("album", album)
-    songs = client.find(*data)
+    songs = library_find(client, *data)
     artists = set(a["artist"] for a in songs)
     if len(artists) == 1:
         album = f"{album} - {artists.pop()}"
@@ -758,49 +790,49 @@ def url_albums_album_track(album, file, *, client, path, query):
     )
 
 
-def url_genres(*, client, path, query):
-    genres = set()
-    for genre_list in client.list("genre"):
-        for genre in genre_list["genre"].replace(";", "/").split("/"):
-            genres.add(genre.strip())
-    genres = sorted(list(genres))
+def li_facet(value, count):
+    link = html_link("None" if value == "" else value, value)
+    return li(link) if count is None else li(link, f" ({count})")
+
 
-    thelist = [li(html_link("None" if a == "" else a, a)) for a in genres]
+def facet_page(facet, value, header, client):
+    songs = find_facet(client, facet, value)
+    thelist = [li_album_artist_title(a) for a in songs]
+    return create_page(header, {"facet": facet, "value": value}, ul(*thelist))
+
+
+def url_genres(*, client, path, query):
+    thelist = [li_facet(*a) for a in facet_values(client, "genre")]
     return create_page("Genres", None, ul(*thelist))
 
 
 def url_genres_genre(genre, *, client, path, query):
-    data = ("genre", "") if genre == "" else (f"(genre contains '{genre}')",)
-    thelist = [li_album_artist_title(a) for a in client.find(*data)]
-    return create_page([html_link("Genres", ".."), genre], {"find": data}, ul(*thelist))
+    return facet_page("genre", genre, [html_link("Genres", ".."), genre], client)
 
 
 def url_dates(*, client, path, query):
-    dates = set(a["originaldate"][:4] for a in client.list("originaldate"))
+    years = collections.defaultdict(list)
+    for year, count in reversed(facet_values(client, "year")):
+        years[f"{year[:3]}0s" if year else ""].append(li_facet(year, count))
     thelist = [
-        li(html_link("None" if a == "" else a, a)) for a in reversed(sorted(dates))
+        li(html_link("None" if decade == "" else decade, decade), ul(*decade_years))
+        for decade, decade_years in years.items()
     ]
     return create_page("Dates", None, ul(*thelist))
 
 
 def url_dates_date(date, *, client, path, query):
-    data = (
-        ("originaldate", "") if date == "" else (f"(originaldate contains '{date}')",)
-    )
-    thelist = [li_album_artist_title(a) for a in client.find(*data)]
-    return create_page([html_link("Dates", ".."), date], {"find": data}, ul(*thelist))
+    facet = "decade" if date.endswith("0s") else "year"
+    return facet_page(facet, date, [html_link("Dates", ".."), date], client)
 
 
 def url_labels(*, client, path, query):
-    labels = [a["label"] for a in client.list("label")]
-    thelist = [li(html_link("None" if a == "" else a, a)) for a in labels]
+    thelist = [li_facet(*a) for a in facet_values(client, "label")]
     return create_page("Labels", None, ul(*thelist))
 
 
 def url_labels_label(label, *, client, path, query):
-    data = ("label", label)
-    thelist = [li_album_artist_title(a) for a in client.find(*data)]
-    return create_page([html_link("Labels", ".."), label], {"find": data}, ul(*thelist))
+    return facet_page("label", label, [html_link("Labels", ".."), label], client)
 
 
 def url_file(file, *, client, path, query):
@@ -866,22 +898,67 @@ matcher = {
 }
 
 
-def handle_get(client, path, query):
-    for pattern, func in matcher.items():
-        matches = re.fullmatch(pattern, path)
-        if matches:
-            resp = func(
-                *(unquote_plus(g) for g in matches.groups()),
-                client=client,
-                path=unquote_plus(path),
-                query=query,
-            )
-            if isinstance(resp, tuple):
-                lines = resp[0]
-                headers = resp[1]
-            else:
-                lines = resp
-                headers = {}
-            return get_header(client, path) + lines, headers
+# Pages that only depend on the database, their rendered output is cached
+cached_pages = {
+    url_artists,
+    url_artists_artist,
+    url_artists_artist_all,
+    url_artists_artist_album,
+    url_artists_artist_album_track,
+    url_albums,
+    url_albums_album,
+    url_albums_album_track,
+    url_genres,
+    url_genres_genre,
+    url_dates,
+    url_dates_date,
+    url_labels,
+    url_labels_label,
+    url_file,
+}
+
+
+def page_size(resp):
+    lines = resp[0] if isinstance(resp, tuple) else resp
+    # Encoded, as the cache's budget is in bytes
+    return sum(len(line.encode("utf-8")) for line in lines)
+
 
-    return get_header(client, path) + [h2("Page not found"), p(path)], {"code": 404}
+def cache_page(route, func):
+    def wrapper(*args, client, path, query):
+        def render():
+            return func(*args, client=client, path=path, query=query)
+
+        if "_random" in args:
+            return render()
+        key = (path, freeze(query))
+        return page_cache.get(route.pattern, key, render, page_size)
+
+    return wrapper
+
+
+router = Router()
+for pattern, func in matcher.items():
+    router.add(pattern, func)
+router.wrap(cache_page, [p for p, f in matcher.items() if f in cached_pages])
+router.compile()
+
+
+def handle_get(client, path, query, func, args):
+    # With the handler and args router.resolve found for the path
+    if func is None:
+        return get_header(client, path) + [h2("Page not found"), p(path)], {"code": 404}
+
+    resp = func(
+        *(unquote_plus(g) for g in args),
+        client=client,
+        path=unquote_plus(path),
+        query=query,
+    )
+    if isinstance(resp, tuple):
+        lines = resp[0]
+        headers = resp[1]
+    else:
+        lines = resp
+        headers = {}
+    return get_header(client, path) + lines, headers
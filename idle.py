@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+
+import mpd
+
+
+class IdleWatcher:
+    def __init__(self, connect, max_backoff=30):
+        self.connect = connect
+        self.max_backoff = max_backoff
+        self.subscribers = []
+        self.thread = None
+        self.connected = threading.Event()
+
+    def subscribe(self, callback, *subsystems):
+        # callback(changed, client) runs on the watcher thread with its own
+        # connection, before it goes back to idling.
+        self.subscribers.append((callback, set(subsystems)))
+
+    @property
+    def subsystems(self):
+        return sorted(set().union(*(s for _, s in self.subscribers)))
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="mpd-idle-watcher", daemon=True
+        )
+        self.thread.start()
+
+    def dispatch(self, changed, client):
+        changed = set(changed)
+        for callback, subsystems in self.subscribers:
+            wanted = changed & subsystems
+            if not wanted:
+                continue
+            try:
+                callback(wanted, client)
+            except mpd.ConnectionError:
+                raise
+            except Exception:
+                logging.exception("Idle subscriber %r failed", callback)
+
+    def run(self):
+        failures = 0
+        while True:
+            try:
+                client = self.connect()
+            except (OSError, mpd.ConnectionError) as e:
+                failures += 1
+                backoff = min(self.max_backoff, 0.5 * 2 ** (failures - 1))
+                logging.warning("Idle watcher could not connect (%s), retrying in %.1fs", e, backoff)
+                time.sleep(backoff)
+                continue
+
+            failures = 0
+            try:
+                # Anything may have changed while disconnected
+                self.dispatch(self.subsystems, client)
+                self.connected.set()
+                while True:
+                    self.dispatch(client.idle(*self.subsystems), client)
+            except (OSError, mpd.ConnectionError) as e:
+                logging.warning("Idle watcher lost connection: %s", e)
+            finally:
+                self.connected.clear()
+                try:
+                    client.disconnect()
+                except Exception:
+                    pass
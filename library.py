@@ -0,0 +1,182 @@
+import logging
+import threading
+import time
+
+import mpd
+
+from api import connect_client, info_pairs, iterating, simplify_title_list
+from cache import freeze, library_cache
+from store import LibraryStore
+
+
+# Tags kept for every song, enough to list, search and group them
+SONG_KEYS = (
+    "file",
+    "track",
+    "title",
+    "name",
+    "artist",
+    "albumartist",
+    "album",
+    "genre",
+    "originaldate",
+    "label",
+    "duration",
+)
+
+
+class LibrarySnapshot:
+    # Every song in the database, fetched once per database version on a
+    # connection and thread of its own into a LibraryStore, and the indexes
+    # built from it.
+    def __init__(self, connect):
+        self.connect = connect
+        self.builders = {}
+        # (database version, store, {name: index}), swapped in one go
+        self.current = (None, None, {})
+        self.songs = 0
+        self.build_seconds = None
+        self.pending = threading.Event()
+        self.thread = None
+
+    def register(self, name, builder):
+        # builder(songs) returns the index, songs is the LibraryStore
+        self.builders[name] = builder
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="library-indexer", daemon=True
+        )
+        self.thread.start()
+
+    def on_database(self, changed, client):
+        # Building takes a while on big libraries, do it off the idle thread
+        self.pending.set()
+
+    def fetch(self):
+        client = self.connect()
+        try:
+            # Straight into the store, the whole library is never dicts
+            songs = LibraryStore(SONG_KEYS)
+            with iterating(client):
+                for song in client.listallinfo():
+                    if "file" in song:
+                        songs.append(song)
+            songs.finish()
+            return songs
+        finally:
+            try:
+                client.disconnect()
+            except Exception:
+                pass
+
+    def build(self):
+        version = library_cache.version
+        if version is not None and version == self.current[0]:
+            # The idle watcher reconnected, the database is the same
+            return
+        started = time.monotonic()
+        songs = self.fetch()
+        indexes = {name: build(songs) for name, build in self.builders.items()}
+        self.current = (version, songs, indexes)
+        self.songs = len(songs)
+        self.build_seconds = time.monotonic() - started
+        logging.info("Indexed %d songs in %.2fs", len(songs), self.build_seconds)
+
+    def run(self):
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            try:
+                self.build()
+            except (OSError, mpd.MPDError) as e:
+                logging.warning("Could not index the library: %s", e)
+                time.sleep(5)
+                self.pending.set()
+
+    def get(self, name):
+        # None until there is an index for the current database, callers
+        # should ask MPD instead.
+        version, songs, indexes = self.current
+        if version is None or version != library_cache.version:
+            return None
+        return indexes.get(name)
+
+    def store(self):
+        # The LibraryStore of the current database, like get()
+        version, songs, indexes = self.current
+        if version is None or version != library_cache.version:
+            return None
+        return songs
+
+    def stats(self):
+        version, songs, indexes = self.current
+        return {
+            "version": version,
+            "indexes": sorted(indexes),
+            "songs": self.songs,
+            "build_seconds": self.build_seconds,
+        }
+
+
+library_snapshot = LibrarySnapshot(connect_client)
+
+
+def library_list(client, *args):
+    # MPD's list, answered by the store when it can. Cached the same either
+    # way, the store's dicts share their strings.
+    def fetch():
+        store = library_snapshot.store()
+        listed = None if store is None else store.list(*args)
+        return client.list(*args) if listed is None else listed
+
+    return library_cache.get(("list", *freeze(args)), fetch)
+
+
+def library_find(client, *args):
+    # MPD's find, as the store's songs with only SONG_KEYS when it can
+    def fetch():
+        store = library_snapshot.store()
+        found = None if store is None else store.find(*args)
+        return client.find(*args) if found is None else found
+
+    return library_cache.get(("find", *freeze(args)), fetch)
+
+
+@library_cache.cached
+def list_artists(client):
+    return [a["artist"] for a in library_list(client, "artist")]
+
+
+@library_cache.cached
+def list_albumartists(client):
+    return [a["albumartist"] for a in library_list(client, "albumartist")]
+
+
+def list_albums(client, query):
+    return find_albums(client, info_pairs(query, ("artist", "albumartist")))
+
+
+@library_cache.cached
+def find_albums(client, pairs):
+    return [a["album"] for a in library_list(client, "album", *pairs)]
+
+
+def list_titles(client, query):
+    if "playlist" in query:
+        return simplify_title_list(client.listplaylistinfo(query["playlist"]))
+
+    pairs = info_pairs(
+        query, ("artist", "albumartist", "album", "genre", "originaldate", "label")
+    )
+    return find_titles(client, pairs)
+
+
+@library_cache.cached
+def find_titles(client, pairs):
+    if pairs:
+        titles = library_find(client, *pairs)
+    else:
+        titles = library_list(client, "title")
+
+    return simplify_title_list(titles)
@@ -0,0 +1,240 @@
+import bisect
+import threading
+import time
+
+import mpd
+
+from tracing import current_trace
+
+
+# Seconds, roughly log spaced from fast cache hits to slow library scans
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+
+# name -> (type, help, label names)
+METRICS = {
+    "wempd_http_requests_total": (
+        "counter",
+        "HTTP requests handled",
+        ("method", "route", "code"),
+    ),
+    "wempd_http_request_seconds": (
+        "histogram",
+        "Time to handle an HTTP request",
+        ("method", "route", "code"),
+    ),
+    "wempd_http_received_bytes_total": (
+        "counter",
+        "HTTP request body bytes received",
+        ("method", "route"),
+    ),
+    "wempd_http_sent_bytes_total": (
+        "counter",
+        "HTTP response bytes sent, including headers",
+        ("method", "route"),
+    ),
+    "wempd_mpd_commands_total": (
+        "counter",
+        "MPD commands sent, including those in command lists",
+        ("command",),
+    ),
+    "wempd_mpd_command_seconds": (
+        "histogram",
+        "MPD round trip time per command, command lists as a whole",
+        ("command",),
+    ),
+    "wempd_mpd_errors_total": (
+        "counter",
+        "MPD commands that failed",
+        ("command", "error"),
+    ),
+}
+
+
+class Metrics:
+    # Every thread updates a shard of its own without locking, collecting
+    # sums them. Copying a dict is atomic under the GIL, a histogram may be
+    # read mid-update but only ever one observation out.
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.samples = []
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        shard = self.shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        shard = self.shard()
+        key = (name, labels)
+        hist = shard.get(key)
+        if hist is None:
+            # Per bucket counts, then +Inf, then the sum
+            hist = shard[key] = [0] * (len(buckets) + 2)
+        hist[bisect.bisect_left(buckets, value)] += 1
+        hist[-1] += value
+
+    def sample(self, name, kind, help, func, labels=()):
+        # For values kept elsewhere, read when rendering. func() returns the
+        # value, or [(label values, value)] when there are labels.
+        self.samples.append((name, kind, help, func, labels))
+
+    def collect(self):
+        with self.lock:
+            shards = list(self.shards)
+        totals = {}
+        for shard in shards:
+            for key, value in dict(shard).items():
+                if isinstance(value, list):
+                    total = totals.setdefault(key, [0] * len(value))
+                    for i, v in enumerate(value):
+                        total[i] += v
+                else:
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self):
+        by_name = {}
+        for (name, labels), value in sorted(self.collect().items()):
+            by_name.setdefault(name, []).append((labels, value))
+
+        lines = []
+        for name, (kind, help, label_names) in METRICS.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in by_name.get(name, []):
+                pairs = list(zip(label_names, labels))
+                if kind == "histogram":
+                    lines += render_histogram(name, pairs, value)
+                else:
+                    lines.append(f"{name}{format_labels(pairs)} {value}")
+
+        for name, kind, help, func, label_names in self.samples:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            value = func()
+            samples = value if label_names else [((), value)]
+            for labels, v in samples:
+                if v is not None:
+                    pairs = list(zip(label_names, labels))
+                    lines.append(f"{name}{format_labels(pairs)} {v}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in pairs) + "}"
+
+
+def render_histogram(name, pairs, hist, buckets=LATENCY_BUCKETS):
+    lines = []
+    count = 0
+    for bound, n in zip((*buckets, "+Inf"), hist[:-1]):
+        count += n
+        labels = format_labels(pairs + [("le", bound)])
+        lines.append(f"{name}_bucket{labels} {count}")
+    lines.append(f"{name}_sum{format_labels(pairs)} {hist[-1]}")
+    lines.append(f"{name}_count{format_labels(pairs)} {count}")
+    return lines
+
+
+metrics = Metrics()
+
+
+class CountingReader:
+    def __init__(self, rfile, client):
+        self.rfile = rfile
+        self.client = client
+
+    def readline(self, *args):
+        line = self.rfile.readline(*args)
+        self.client.received += len(line)
+        return line
+
+    def read(self, *args):
+        data = self.rfile.read(*args)
+        self.client.received += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.rfile, name)
+
+
+@mpd.base.mpd_command_provider
+class MPDClient(mpd.MPDClient):
+    # Counts and times every command, and adds it to the request's trace. The
+    # provider decorator is needed for the commands to be bound to this
+    # _execute rather than the base class's.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.received = 0
+        self.listed = []
+
+    def connect(self, *args, **kwargs):
+        super().connect(*args, **kwargs)
+        self._rbfile = CountingReader(self._rbfile, self)
+
+    def _execute(self, command, args, retval):
+        metrics.inc("wempd_mpd_commands_total", (command,))
+        if self._command_list is not None:
+            # Timed when the list ends
+            self.listed.append(command)
+            return super()._execute(command, args, retval)
+        if command == "idle":
+            # Idling isn't latency
+            return super()._execute(command, args, retval)
+        return self.timed(command, super()._execute, command, args, retval)
+
+    def _execute_binary(self, command, args):
+        metrics.inc("wempd_mpd_commands_total", (command,))
+        return self.timed(command, super()._execute_binary, command, args)
+
+    def command_list_end(self):
+        listed, self.listed = self.listed, []
+        traced = f"command_list[{','.join(listed)}]"
+        return self.timed("command_list", super().command_list_end, traced=traced)
+
+    def timed(self, name, func, *args, traced=None):
+        started = time.perf_counter()
+        received = self.received
+        try:
+            return func(*args)
+        except mpd.MPDError as e:
+            metrics.inc("wempd_mpd_errors_total", (name, type(e).__name__))
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe("wempd_mpd_command_seconds", (name,), elapsed)
+            trace = current_trace()
+            if trace is not None:
+                trace.record(traced or name, elapsed, self.received - received)
@@ -0,0 +1,192 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+import mpd
+
+
+class ConnectionPool:
+    def __init__(self, connect, size=8, health_interval=30, timeout=30, max_backoff=30):
+        self.connect = connect
+        self.size = size
+        self.health_interval = health_interval
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(size)
+        # (client, last_used) pairs, most recently used on the right
+        self.idle = collections.deque()
+        self.failures = 0
+        self.retry_at = 0
+
+        self.connects = 0
+        self.dropped = 0
+
+        self.stopped = threading.Event()
+        self.health_thread = None
+
+    def start(self):
+        self.health_thread = threading.Thread(
+            target=self.health_loop, name="mpd-pool-health", daemon=True
+        )
+        self.health_thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.lock:
+            idle, self.idle = self.idle, collections.deque()
+        for client, _ in idle:
+            self.discard(client)
+
+    def new_client(self):
+        with self.lock:
+            wait = self.retry_at - time.monotonic()
+        if wait > 0:
+            raise mpd.ConnectionError(f"MPD unavailable, retrying in {wait:.1f}s")
+
+        try:
+            client = self.connect()
+        except (OSError, mpd.ConnectionError) as e:
+            with self.lock:
+                self.failures += 1
+                backoff = min(self.max_backoff, 0.5 * 2 ** (self.failures - 1))
+                self.retry_at = time.monotonic() + backoff
+            logging.warning("Could not connect to MPD (%s), backing off %.1fs", e, backoff)
+            raise mpd.ConnectionError(str(e)) from e
+
+        with self.lock:
+            self.failures = 0
+            self.retry_at = 0
+            self.connects += 1
+        return client
+
+    def discard(self, client):
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+
+    def checkout(self, fresh=False):
+        # (client, whether it was pooled rather than new)
+        if not self.slots.acquire(timeout=self.timeout):
+            raise mpd.ConnectionError("No MPD connection available")
+
+        with self.lock:
+            if self.idle and not fresh:
+                return self.idle.pop()[0], True
+
+        try:
+            return self.new_client(), False
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def checkin(self, client, broken=False, flush=False):
+        try:
+            if broken:
+                self.discard(client)
+                idle = []
+                with self.lock:
+                    if flush:
+                        idle, self.idle = self.idle, collections.deque()
+                    self.dropped += 1 + len(idle)
+                for idle_client, _ in idle:
+                    self.discard(idle_client)
+            else:
+                with self.lock:
+                    self.idle.append((client, time.monotonic()))
+        finally:
+            self.slots.release()
+
+    @contextlib.contextmanager
+    def connection(self, fresh=False):
+        client, _ = self.checkout(fresh)
+        with self.returning(client):
+            yield client
+
+    def run(self, func, retry=None):
+        # func(client) on a pooled connection. A pooled one can have died
+        # since it was last used, as when MPD restarts: then if retry() says
+        # func can run again, it does once on a new connection.
+        client, pooled = self.checkout()
+        try:
+            with self.returning(client):
+                return func(client)
+        except mpd.ConnectionError as e:
+            if not pooled or retry is None or not retry():
+                raise
+            logging.info("Pooled MPD connection was dead (%s), retrying", e)
+
+        with self.connection(fresh=True) as client:
+            return func(client)
+
+    @contextlib.contextmanager
+    def returning(self, client):
+        # Back to the pool, unless what happened leaves it unusable
+        try:
+            yield
+        except mpd.CommandError:
+            self.checkin(client)
+            raise
+        except mpd.ConnectionError:
+            # A dead connection usually means MPD went away, so the idle ones
+            # are most likely dead too.
+            self.checkin(client, broken=True, flush=True)
+            raise
+        except BaseException:
+            # The protocol stream may be half read, don't hand it out again.
+            self.checkin(client, broken=True)
+            raise
+        else:
+            self.checkin(client)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": self.size,
+                "idle": len(self.idle),
+                "connects": self.connects,
+                "dropped": self.dropped,
+                "failures": self.failures,
+            }
+
+    def health_loop(self):
+        while not self.stopped.wait(self.health_interval):
+            try:
+                self.health_check()
+            except Exception:
+                logging.exception("MPD pool health check failed")
+
+    def health_check(self):
+        cutoff = time.monotonic() - self.health_interval
+        with self.lock:
+            stale = [entry for entry in self.idle if entry[1] <= cutoff]
+            for entry in stale:
+                self.idle.remove(entry)
+
+        alive = []
+        for client, _ in stale:
+            try:
+                client.ping()
+                alive.append((client, time.monotonic()))
+            except (OSError, mpd.ConnectionError):
+                self.discard(client)
+                with self.lock:
+                    self.dropped += 1
+
+        with self.lock:
+            self.idle.extendleft(reversed(alive))
+            surplus = [self.idle.popleft() for _ in range(len(self.idle) - self.size)]
+            reconnect = self.failures and time.monotonic() >= self.retry_at
+
+        for client, _ in surplus:
+            self.discard(client)
+
+        # Bring MPD back in the background rather than on a request
+        if reconnect:
+            with contextlib.suppress(mpd.ConnectionError):
+                with self.connection():
+                    pass
@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+import time
+
+import mpd
+
+from art import art_cache, thumbnail_format
+from library import library_snapshot
+
+
+class ArtPrefetcher:
+    # Fetches art into the cache before the browser asks for it: the current
+    # song's and the next ones' whenever the player or queue changes, and
+    # optionally every song's after the library is indexed. One thread of its
+    # own at a lower priority than requests, borrowing pooled connections.
+    def __init__(self, cache, ahead=3, sizes=(), library=False):
+        # Context manager factory for an MPD connection, given by start
+        self.connection = None
+        self.cache = cache
+        self.ahead = ahead
+        # Thumbnails made too, in the format the SPA asks for
+        self.sizes = sizes
+        self.fmt = thumbnail_format("image/webp")
+        self.library = library
+
+        self.wake = threading.Event()
+        self.queue_changed = False
+        # The library's songs and the position of the next to warm
+        self.library_songs = ()
+        self.library_pos = 0
+        self.warmed = 0
+        self.thread = None
+
+    def start(self, connection):
+        self.connection = connection
+        self.thread = threading.Thread(
+            target=self.run, name="art-prefetch", daemon=True
+        )
+        self.thread.start()
+
+    def on_idle(self, changed, client):
+        self.queue_changed = True
+        self.wake.set()
+
+    def on_library(self, songs):
+        # A library snapshot builder, runs when the database has been indexed
+        if not self.library:
+            return None
+        self.library_songs, self.library_pos = songs, 0
+        self.wake.set()
+        return len(songs)
+
+    def run(self):
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            try:
+                self.prefetch()
+            except (OSError, mpd.MPDError) as e:
+                logging.warning("Could not prefetch art: %s", e)
+                time.sleep(5)
+                self.wake.set()
+
+    def prefetch(self):
+        if self.queue_changed:
+            self.queue_changed = False
+            with self.connection() as client:
+                for file in self.upcoming(client):
+                    self.warm(client, file)
+
+        # Library songs until the queue changes again, which comes first. A
+        # connection per song, so requests aren't kept waiting for one.
+        while self.library_pos < len(self.library_songs) and not self.queue_changed:
+            with self.connection() as client:
+                self.warm(client, self.library_songs[self.library_pos]["file"])
+            self.library_pos += 1
+
+    def upcoming(self, client):
+        status = client.status()
+        if status.get("random") == "1":
+            # Only the next song is known when shuffling
+            positions = [int(status[k]) for k in ("song", "nextsong") if k in status]
+            if not positions:
+                return []
+            client.command_list_ok_begin()
+            for pos in positions:
+                client.playlistinfo(pos)
+            return [songs[0]["file"] for songs in client.command_list_end() if songs]
+
+        length = int(status.get("playlistlength", 0))
+        start = int(status.get("song", 0))
+        end = min(length, start + self.ahead + 1)
+        if start >= end:
+            return []
+        return [song["file"] for song in client.playlistinfo((start, end))]
+
+    def warm(self, client, file):
+        for size in (None, *self.sizes):
+            art = self.cache.open(client, file, size, self.fmt, count=False)
+            if art is None:
+                return
+            art[0].close()
+        self.warmed += 1
+
+    def stats(self):
+        return {
+            "ahead": self.ahead,
+            "sizes": list(self.sizes),
+            "warmed": self.warmed,
+            "library_pending": len(self.library_songs) - self.library_pos,
+        }
+
+
+art_prefetcher = ArtPrefetcher(
+    art_cache,
+    ahead=int(os.getenv("WEMPD_ART_PREFETCH", "3")),
+    sizes=tuple(
+        int(size)
+        for size in os.getenv("WEMPD_ART_PREFETCH_SIZES", "512,1024").split(",")
+        if size
+    ),
+    library=os.getenv("WEMPD_ART_PREFETCH_LIBRARY", "0") == "1",
+)
+library_snapshot.register("art_songs", art_prefetcher.on_library)
@@ -0,0 +1,77 @@
+import re
+
+
+class Route:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.groups = re.compile(pattern).groups
+        # method -> handler
+        self.handlers = {}
+
+    def __repr__(self):
+        return f"Route({self.pattern!r})"
+
+
+class Router:
+    # Routes are tried in the order they were added, like a list of
+    # re.fullmatch calls, but all at once with one compiled pattern.
+    def __init__(self):
+        self.routes = []
+        self.by_pattern = {}
+        self.regex = None
+        self.offsets = {}
+
+    def add(self, pattern, handler, methods=("GET",)):
+        route = self.by_pattern.get(pattern)
+        if route is None:
+            route = self.by_pattern[pattern] = Route(pattern)
+            self.routes.append(route)
+            self.regex = None
+        for method in methods:
+            route.handlers[method] = handler
+        return route
+
+    def route(self, pattern, methods=("GET",)):
+        def decorator(handler):
+            self.add(pattern, handler, methods)
+            return handler
+
+        return decorator
+
+    def wrap(self, wrapper, patterns=None):
+        # Replaces handlers with wrapper(route, handler), for caching or
+        # metrics on all routes or the given ones.
+        for route in self.routes:
+            if patterns is None or route.pattern in patterns:
+                for method, handler in route.handlers.items():
+                    route.handlers[method] = wrapper(route, handler)
+
+    def compile(self):
+        # Each route becomes a named group, lastgroup says which one matched
+        # and its own groups follow it.
+        parts = []
+        group = 1
+        self.offsets = {}
+        for i, route in enumerate(self.routes):
+            parts.append(f"(?P<r{i}>{route.pattern})")
+            self.offsets[f"r{i}"] = (route, group + 1)
+            group += 1 + route.groups
+        self.regex = re.compile("|".join(parts))
+
+    def match(self, path):
+        # Returns (route, args), or (None, ()) when nothing matches
+        if self.regex is None:
+            self.compile()
+        m = self.regex.fullmatch(path)
+        if m is None:
+            return None, ()
+        route, start = self.offsets[m.lastgroup]
+        return route, m.groups()[start - 1 : start - 1 + route.groups]
+
+    def resolve(self, method, path):
+        # Returns (route, handler, args), the handler is None when the path
+        # matches but not for this method.
+        route, args = self.match(path)
+        if route is None:
+            return None, None, ()
+        return route, route.handlers.get(method), args
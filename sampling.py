@@ -0,0 +1,133 @@
+import array
+import random
+
+from cache import library_cache
+from facets import facet_filter, normalize, song_facets, tag_values
+from library import library_snapshot
+
+
+# Kind -> the tags a pick is made of, usable as a find or append filter
+KINDS = {
+    "album": ("album", "albumartist"),
+    "artist": ("artist",),
+    "albumartist": ("albumartist",),
+    "track": ("file",),
+}
+# Facets picks can be limited to
+FILTERS = ("genre", "year")
+
+
+def pick_values(song, tag):
+    # MPD falls back to the artist for songs without an album artist
+    values = [value for value in tag_values(song, tag) if value]
+    if not values and tag == "albumartist":
+        return pick_values(song, "artist")
+    return values
+
+
+def song_picks(song, tags):
+    if len(tags) == 1:
+        # One pick per value of multi-valued tags, like MPD's list does
+        return [(value,) for value in pick_values(song, tags[0])]
+    pick = tuple((pick_values(song, tag) or [""])[0] for tag in tags)
+    return [pick] if pick[0] else []
+
+
+class RandomIndex:
+    # Every distinct pick of each kind, and per genre and year the positions
+    # of those with songs in it, as compact arrays. Tracks are picked by row
+    # of the library rather than keeping every file a second time.
+    def __init__(self, songs):
+        self.library = songs
+        positions = {kind: {} for kind in KINDS if kind != "track"}
+        filtered = {kind: {facet: {} for facet in FILTERS} for kind in KINDS}
+        for row, song in enumerate(songs):
+            facets = [
+                (facet, normalize(value))
+                for facet, value in song_facets(song)
+                if facet in FILTERS and value
+            ]
+            for kind, tags in KINDS.items():
+                if kind == "track":
+                    found = (row,)
+                else:
+                    picked = positions[kind]
+                    found = [
+                        picked.setdefault(pick, len(picked))
+                        for pick in song_picks(song, tags)
+                    ]
+                for facet, value in facets:
+                    filtered[kind][facet].setdefault(value, set()).update(found)
+
+        self.picks = {kind: list(picked) for kind, picked in positions.items()}
+        self.picks["track"] = range(len(songs))
+        self.filtered = {
+            kind: {
+                facet: {
+                    value: array.array("I", sorted(found))
+                    for value, found in values.items()
+                }
+                for facet, values in by_facet.items()
+            }
+            for kind, by_facet in filtered.items()
+        }
+
+    def pick(self, kind, pos):
+        if kind == "track":
+            return (self.library[pos]["file"],)
+        return self.picks[kind][pos]
+
+    def sample(self, kind, count, filters):
+        matches = [
+            self.filtered[kind][facet].get(normalize(value), ())
+            for facet, value in filters
+        ]
+        if not matches:
+            candidates = range(len(self.picks[kind]))
+        else:
+            # The narrowest filter's positions, in all the others too
+            matches.sort(key=len)
+            candidates = matches[0]
+            if len(matches) > 1:
+                others = [set(m) for m in matches[1:]]
+                candidates = [p for p in candidates if all(p in o for o in others)]
+        chosen = random.sample(candidates, min(count, len(candidates)))
+        return [self.pick(kind, pos) for pos in chosen]
+
+
+def candidate_filter(filters):
+    # The MPD filter for the facets, when the index isn't ready
+    expressions = []
+    for facet, value in filters:
+        expression = facet_filter(facet, value)
+        if len(expression) == 2:
+            expression = (f"({expression[0]} == '{expression[1]}')",)
+        expressions += expression
+    if len(expressions) > 1:
+        return (f"({' AND '.join(expressions)})",)
+    return tuple(expressions)
+
+
+@library_cache.cached
+def list_picks(client, kind, filters):
+    tags = KINDS[kind]
+    groups = [arg for tag in tags[1:] for arg in ("group", tag)]
+    listed = client.list(tags[0], *candidate_filter(filters), *groups)
+    return sorted({pick for entry in listed for pick in song_picks(entry, tags)})
+
+
+def random_picks(client, kind, count=1, filters=()):
+    # [{tag: value}] of up to count distinct picks, filters as (facet, value)
+    tags = KINDS[kind]
+    index = library_snapshot.get("random")
+    if index is not None:
+        picks = index.sample(kind, count, filters)
+    else:
+        picks = list_picks(client, kind, tuple(filters))
+        picks = random.sample(picks, min(count, len(picks)))
+    # Without the tags a pick has no value for, as finding "" matches nothing
+    # when MPD falls back to another tag
+    return [{tag: value for tag, value in zip(tags, pick) if value} for pick in picks]
+
+
+library_snapshot.register("random", RandomIndex)
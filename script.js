@@ -2,6 +2,8 @@
 
 // Global variables ///////////////////////////////////////////////////////////
 const NOTIFICATION_TIMEOUT = 3000;
+// Results fetched while typing, the best ranked ones are enough
+const TYPEAHEAD_LIMIT = 20;
 
 function svg_icon(svg) {
 	return `<svg class="svg-icon" viewBox="0 0 10 10" xmlns="http://www.w3.org/2000/svg">${svg}</svg>`;
@@ -137,9 +139,9 @@ function fetch_json(url, params) {
 		});
 }
 
-function fetch_blob(url, params) {
+function fetch_blob(url, params, headers) {
 	//console.error('fetch blob, ', url);
-	return fetch(url_with_params("api/" + url, params), {'method': 'GET'})
+	return fetch(url_with_params("api/" + url, params), {'method': 'GET', headers})
 		.catch((error) => {
 			show_error(`Cannot connect to server: ${error}`);
 			return {};
@@ -447,7 +449,9 @@ function populate_song_info(all_status) {
 	if (currentsong.file) {
 		if (window.cur_file !== currentsong.file) {
 			window.cur_file = currentsong.file;
-			wait(100).then(() => fetch_blob('art', {file: currentsong.file})
+			// Big enough for the info panel, which shows the same image
+			const size = Math.round(300 * (window.devicePixelRatio || 1));
+			wait(100).then(() => fetch_blob('art', {file: currentsong.file, size}, {Accept: 'image/webp,image/*;q=0.8'})
 				.then((resp) => (resp.status === 200) ? resp.blob() : null)
 				.then(set_albumart));
 		}
@@ -596,8 +600,8 @@ function show_search_results(results, query) {
 				},
 				oninput: debounce((e) => {
 					const query = e.target.value;
-					if (!query || query.length <= 3) { return; }
-					fetch_json('search', {query}).then((resp) => update_search_results(resp, query));
+					if (!query || query.length < 2) { return; }
+					fetch_json('search', {query, limit: TYPEAHEAD_LIMIT}).then((resp) => update_search_results(resp, query));
 				}, 200),
 			}, [
 				E('input', {type: 'text', name: 'query', value: query}),
@@ -605,7 +609,8 @@ function show_search_results(results, query) {
 			]),
 		]),
 		E('table', {id: 'results-table'},
-			populate_search_results(results.sort((a, b) => a.title.localeCompare(b.title)))
+			// In the server's order, best matches first
+			populate_search_results(results)
 		)
 	]));
 }
@@ -878,91 +883,151 @@ function populate_artists(artists) {
 }
 
 // Queue
-function move_song(from_id, to_pos) {
-	post_json('move', {from: from_id, to: to_pos}).then(update_queue);
+function queue_batch(ops) {
+	// Queue edits in one request, the reply has the changes to the queue
+	return post_json('batch', {ops, version: queue_version()})
+		.then((resp) => {
+			if (resp.queue)
+				apply_queue_changes(resp.queue);
+			return resp;
+		});
 }
 
-function populate_queue(queue) {
-	getID('queue').replaceChildren(
-		create_table_row(['', 'Title', 'Album', 'Artist', 'Length'], true),
-		...queue.map(song => E('tr', {class: song.current ? 'current' : null}, [
-			E('td', song.track || ''),
-			E('td', {
-				oncontextmenu: (e) => {
-					e.preventDefault();
-					draw_context_menu(e.x, e.y, [
-						{title: 'Remove song', command: () => remove_from_queue({ids: [song.pos]})},
-					]);
-				},
-			}, E('a', {href: '#', onclick: () => locate_title(song)}, song.title || song.name || song.file)),
-			E('td', {
-				oncontextmenu: (e) => {
-					e.preventDefault();
-					draw_context_menu(e.x, e.y, [
-						{title: 'Remove album', command: () => remove_from_queue({album: song.album})},
-					]);
-				}
-			}, E('a', {href: '#', onclick: () => locate_album(song)}, song.album)),
-			E('td', {
-				oncontextmenu: (e) => {
-					e.preventDefault();
-					draw_context_menu(e.x, e.y, [
-						{title: 'Remove artist', command: () => remove_from_queue({artist: song.artist})},
-						{title: 'Remove album artist', command: () => remove_from_queue({albumartist: song.albumartist})},
-					]);
-				}
-			}, artist_links(song)),
-			E('td', E('span', format_secs(song.duration))),
-			E('td', E('span', {class: 'hflex'}, [
-				E('button', {
-					class: 'hflex',
-					onclick: () => song.current === 'play' ? pause() : post_json('play', {id: song.pos}).then(refresh),
-				}, parseHTML(song.current === 'play' ? pause_icon : play_icon)),
-				E('button', {
-					class: 'hflex',
-					onclick: () => show_info_panel(song),
-				}, parseHTML(info_icon)),
-				E('button', {
-					class: 'hflex',
-					title: 'Move song up',
-					onclick: () => move_song(Number(song.pos), Number(song.pos) - 1),
-				}, parseHTML('&#9650;')),
-				E('button', {
-					class: 'hflex',
-					title: 'Move song down',
-					onclick: () => move_song(Number(song.pos), Number(song.pos) + 1),
-				}, parseHTML('&#9660;')),
-			])),
+function remove_from_queue_batch(ops) {
+	const length = window.queue ? window.queue.length : 0;
+	queue_batch(ops).then((resp) => {
+		if (resp.queue)
+			notify(`Removed ${plural(length - resp.length, 'song', 'songs')}`, remove_icon);
+	});
+}
+
+function move_song(from_pos, to_pos) {
+	if (to_pos < 0 || to_pos >= window.queue.length)
+		return;
+	queue_batch([{op: 'move', from: from_pos, to: to_pos}]);
+}
+
+const queue_header = ['', 'Title', 'Album', 'Artist', 'Length'];
+
+function queue_row(song) {
+	return E('tr', {class: song.current ? 'current' : null}, [
+		E('td', song.track || ''),
+		E('td', {
+			oncontextmenu: (e) => {
+				e.preventDefault();
+				draw_context_menu(e.x, e.y, [
+					{title: 'Remove song', command: () => remove_from_queue_batch([{op: 'delete', from: song.pos, to: Number(song.pos) + 1}])},
+				]);
+			},
+		}, E('a', {href: '#', onclick: () => locate_title(song)}, song.title || song.name || song.file)),
+		E('td', {
+			oncontextmenu: (e) => {
+				e.preventDefault();
+				draw_context_menu(e.x, e.y, [
+					{title: 'Remove album', command: () => remove_from_queue({album: song.album})},
+				]);
+			}
+		}, E('a', {href: '#', onclick: () => locate_album(song)}, song.album)),
+		E('td', {
+			oncontextmenu: (e) => {
+				e.preventDefault();
+				draw_context_menu(e.x, e.y, [
+					{title: 'Remove artist', command: () => remove_from_queue({artist: song.artist})},
+					{title: 'Remove album artist', command: () => remove_from_queue({albumartist: song.albumartist})},
+				]);
+			}
+		}, artist_links(song)),
+		E('td', E('span', format_secs(song.duration))),
+		E('td', E('span', {class: 'hflex'}, [
+			E('button', {
+				class: 'hflex',
+				onclick: () => song.current === 'play' ? pause() : post_json('play', {id: song.pos}),
+			}, parseHTML(song.current === 'play' ? pause_icon : play_icon)),
+			E('button', {
+				class: 'hflex',
+				onclick: () => show_info_panel(song),
+			}, parseHTML(info_icon)),
+			E('button', {
+				class: 'hflex',
+				title: 'Move song up',
+				onclick: () => move_song(Number(song.pos), Number(song.pos) - 1),
+			}, parseHTML('&#9650;')),
+			E('button', {
+				class: 'hflex',
+				title: 'Move song down',
+				onclick: () => move_song(Number(song.pos), Number(song.pos) + 1),
+			}, parseHTML('&#9660;')),
 		])),
+	]);
+}
+
+function redraw_queue() {
+	getID('queue').replaceChildren(
+		create_table_row(queue_header, true),
+		...window.queue.map(queue_row),
 	);
 }
 
-function update_queue() {
-	return fetch_json('queue').then(populate_queue);
+function queue_version() {
+	// Sent as a string so version 0, meaning everything, isn't dropped
+	return String(window.queue ? window.queue_version : 0);
+}
+
+function apply_queue_changes(delta) {
+	const table = getID('queue');
+	if (delta.full || !window.queue) {
+		window.queue = [];
+		table.replaceChildren(create_table_row(queue_header, true));
+	}
+
+	const queue = window.queue;
+	const dirty = new Set();
+	for (const song of delta.changes) {
+		queue[Number(song.pos)] = song;
+		dirty.add(Number(song.pos));
+	}
+	queue.length = delta.length;
+
+	// The current marker moves without the queue changing
+	const current = delta.song == null ? -1 : Number(delta.song);
+	for (const pos of [window.queue_current, current]) {
+		if (pos >= 0 && pos < queue.length)
+			dirty.add(pos);
+	}
+	for (const pos of dirty) {
+		if (pos < queue.length)
+			queue[pos].current = pos === current ? delta.state : undefined;
+	}
+
+	while (table.rows.length > queue.length + 1)
+		table.deleteRow(-1);
+	for (const pos of [...dirty].sort((a, b) => a - b)) {
+		if (pos >= queue.length)
+			continue;
+		const row = queue_row(queue[pos]);
+		if (pos + 1 < table.rows.length)
+			table.rows[pos + 1].replaceWith(row);
+		else
+			table.append(row);
+	}
+
+	window.queue_version = delta.version;
+	window.queue_current = current;
 }
 
 function remove_from_queue(what) {
 	post_json('remove', what)
-		.then((e) => {
-			notify(`Removed ${plural(e.removed, 'song', 'songs')}`, remove_icon);
-			update_queue();
-		});
+		.then((e) => notify(`Removed ${plural(e.removed, 'song', 'songs')}`, remove_icon));
 }
 
 function insert_to_queue(what) {
 	post_json('insert', what)
-		.then((e) => {
-			notify(`Inserted ${plural(e.inserted, 'song', 'songs')}`, add_icon);
-			update_queue();
-		});
+		.then((e) => notify(`Inserted ${plural(e.inserted, 'song', 'songs')}`, add_icon));
 }
 
 function append_to_queue(what) {
 	post_json('append', what)
-		.then((e) => {
-			notify(`Appended ${plural(e.appended, 'song', 'songs')}`, append_icon);
-			update_queue();
-		});
+		.then((e) => notify(`Appended ${plural(e.appended, 'song', 'songs')}`, append_icon));
 }
 
 // Action functions ///////////////////////////////////////////////////////////
@@ -1007,7 +1072,8 @@ function set_artist_mode(mode) {
 
 	clear_albums();
 	clear_titles();
-	update_queue();
+	if (window.queue)
+		redraw_queue();
 	return get_artists();
 }
 
@@ -1029,30 +1095,61 @@ function check_db_update(info) {
 
 function auto_populate(queue) {
 	if (window.auto_populate_enabled && queue.length < 3) {
-		fetch_json('albums')
-			.then(albums => albums[Math.floor(Math.random() * albums.length)])
-			.then(album => {
-				append_to_queue({'album': album});
+		fetch_json('random', {type: 'album'})
+			.then(([album]) => {
+				if (!album) return;
+				append_to_queue(album);
 				console.log('Auto populate playlist', album);
 			});
 	}
 }
 
 function refresh() {
-	return fetch_json('status')
+	return fetch_json('status', {version: queue_version()})
 		.then((info) => {
-			populate_queue(info.queue);
+			apply_queue_changes(info.queue);
 			populate_song_info(info);
 			check_db_update(info);
-			auto_populate(info.queue);
+			auto_populate(window.queue);
 			return info;
 		});
 }
 
-function pause() { post_json('pause').then(refresh); }
-function stop() { post_json('stop').then(refresh); }
-function next() { post_json('next').then(refresh); }
-function prev() { post_json('prev').then(refresh); }
+function pause() { post_json('pause'); }
+function stop() { post_json('stop'); }
+function next() { post_json('next'); }
+function prev() { post_json('prev'); }
+
+function listen_events() {
+	// MPD changes are pushed by the server, refresh only when something changed
+	const events = new EventSource('api/events');
+	const refresh_soon = debounce(refresh, 50);
+
+	for (const name of ['player', 'playlist', 'mixer', 'options', 'update'])
+		events.addEventListener(name, refresh_soon);
+
+	events.addEventListener('database', () => {
+		if (window.display_mode === 'library') {
+			clear_albums();
+			clear_titles();
+			get_artists();
+		}
+	});
+
+	events.addEventListener('output', () => {
+		if (document.querySelector('.outputs_modal'))
+			get_and_show_outputs();
+	});
+
+	// Catch up on anything missed while disconnected
+	let connected = false;
+	events.addEventListener('open', () => {
+		if (connected)
+			refresh_soon();
+		connected = true;
+	});
+	return events;
+}
 
 function adjust_volume(change) {
 	const volume_slider = getID("volume_slider");
@@ -1106,32 +1203,29 @@ function set_bool_option(mode, value) {
 }
 
 function clear_queue() {
-	post_json('clear').then((resp) => {
-		notify(`Removed ${resp.removed} songs`, remove_icon);
-		update_queue();
-	});
+	post_json('clear').then((resp) => notify(`Removed ${resp.removed} songs`, remove_icon));
 }
 
 function clear_queue_before_current() {
 	const cur_pos = parseInt(window.currentsong.pos);
-	post_json('delete', {from: 0, to: cur_pos}).then((resp) => {
-		notify(`Removed ${resp.removed} songs`, remove_icon);
-		update_queue();
-	});
+	if (cur_pos > 0)
+		remove_from_queue_batch([{op: 'delete', from: 0, to: cur_pos}]);
 }
 
 function clear_queue_except_current() {
 	const cur_pos = parseInt(window.currentsong.pos);
-	post_json('delete', {from: cur_pos+1, to: 1e9}).then((resp1) => {
-		post_json('delete', {from: 0, to: cur_pos}).then((resp2) => {
-			notify(`Removed ${resp1.removed + resp2.removed} songs`, remove_icon);
-			update_queue();
-		});
-	});
+	// After the current song first, so the positions before it stay put
+	const ops = [];
+	if (cur_pos + 1 < window.queue.length)
+		ops.push({op: 'delete', from: cur_pos + 1});
+	if (cur_pos > 0)
+		ops.push({op: 'delete', from: 0, to: cur_pos});
+	if (ops.length)
+		remove_from_queue_batch(ops);
 }
 
 function shuffle_queue() {
-	post_json('shuffle').then(update_queue);
+	post_json('shuffle');
 }
 
 function set_param(key, value) {
@@ -1206,7 +1300,7 @@ function setup() {
 	// Progress meter and label
 	const progress_el = getID('cur_song_progress');
 	progress_el.addEventListener('change', (event) => {
-		post_json('seek', {time: event.target.value}).then(() => refresh());
+		post_json('seek', {time: event.target.value});
 	});
 
 	progress_el.addEventListener('input', (event) => {
@@ -1248,8 +1342,7 @@ function setup() {
 		if (entry.length > 0) {
 			post_json('add', {entry})
 				.catch((here) => console.log('ERROR!', here))
-				.then((info) => notify(`Added ${info.added}`, add_icon))
-				.then(update_queue);
+				.then((info) => notify(`Added ${info.added}`, add_icon));
 				// TODO error handling
 		}
 	});
@@ -1297,7 +1390,7 @@ function setup() {
 		}, false);
 	});
 
-	window.setInterval(refresh, 1000 * 60 * 1); // Refresh every minute
+	listen_events();
 }
 
 window.cur_file = null;
@@ -0,0 +1,127 @@
+import array
+import bisect
+import heapq
+import re
+import unicodedata
+
+from api import simplify_title
+from library import library_snapshot
+
+
+# Matches in earlier fields rank higher
+FIELD_WEIGHTS = {
+    "title": 8,
+    "name": 8,
+    "album": 4,
+    "artist": 2,
+    "albumartist": 2,
+    "file": 1,
+}
+
+
+def normalize(text):
+    # Case and accent insensitive, so "beyonce" finds "Beyoncé"
+    text = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return re.findall(r"\w+", normalize(text))
+
+
+class SearchIndex:
+    def __init__(self, songs):
+        self.songs = songs
+        # token -> (song indexes, ascending, and the weight of the best field
+        # each appears in), as compact arrays rather than a dict per token
+        self.postings = {}
+        for idx, song in enumerate(songs):
+            weights = {}
+            for field, weight in FIELD_WEIGHTS.items():
+                value = song.get(field)
+                if not value:
+                    continue
+                if isinstance(value, list):
+                    value = " ".join(value)
+                for token in tokenize(value):
+                    if weights.get(token, 0) < weight:
+                        weights[token] = weight
+            for token, weight in weights.items():
+                if token not in self.postings:
+                    self.postings[token] = (array.array("I"), array.array("B"))
+                ids, weights = self.postings[token]
+                ids.append(idx)
+                weights.append(weight)
+        # Sorted so a prefix is a contiguous range
+        self.tokens = sorted(self.postings)
+
+    def span(self, term):
+        # Tokens starting with term
+        lo = bisect.bisect_left(self.tokens, term)
+        hi = bisect.bisect_left(self.tokens, term[:-1] + chr(ord(term[-1]) + 1))
+        return self.tokens[lo:hi]
+
+    def match(self, tokens, term, candidates=None):
+        scores = {}
+        for token in tokens:
+            # Whole words beat prefixes
+            bonus = 2 if token == term else 1
+            ids, weights = self.postings[token]
+            if candidates is None:
+                posting = zip(ids, weights)
+            elif len(candidates) * len(ids).bit_length() > len(ids):
+                posting = (p for p in zip(ids, weights) if p[0] in candidates)
+            else:
+                # Few candidates, bisecting for each is cheaper than walking
+                # a long posting list
+                posting = []
+                for idx in candidates:
+                    i = bisect.bisect_left(ids, idx)
+                    if i < len(ids) and ids[i] == idx:
+                        posting.append((idx, weights[i]))
+            for idx, weight in posting:
+                if scores.get(idx, 0) < weight * bonus:
+                    scores[idx] = weight * bonus
+        return scores
+
+    def search(self, text, limit=None):
+        # Every term has to match the start of a word in some field. The
+        # rarest go first so the candidates shrink quickly.
+        terms = []
+        for term in set(tokenize(text)):
+            tokens = self.span(term)
+            size = sum(len(self.postings[t][0]) for t in tokens)
+            terms.append((size, term, tokens))
+        if not terms:
+            return []
+        terms.sort()
+
+        scores = None
+        for _, term, tokens in terms:
+            if scores is None:
+                scores = self.match(tokens, term)
+                continue
+            matched = self.match(tokens, term, scores)
+            scores = {i: s + matched[i] for i, s in scores.items() if i in matched}
+            if not scores:
+                return []
+
+        def key(idx):
+            return (-scores[idx], idx)
+
+        if limit:
+            ranked = heapq.nsmallest(limit, scores, key=key)
+        else:
+            ranked = sorted(scores, key=key)
+        return [self.songs[idx] for idx in ranked]
+
+
+def search_library(text, limit=None):
+    # None when the library hasn't been indexed yet
+    index = library_snapshot.get("search")
+    if index is None:
+        return None
+    return [simplify_title(song) for song in index.search(text, limit)]
+
+
+library_snapshot.register("search", SearchIndex)
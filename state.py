@@ -0,0 +1,217 @@
+import threading
+import time
+
+from api import get_status, list_queue, queue_changes
+
+
+# What to fetch again, and the idle subsystems that change it
+REFRESH = {
+    "status": {"player", "mixer", "options", "playlist", "update"},
+    "currentsong": {"player", "playlist"},
+    "outputs": {"output"},
+    "queue": {"playlist"},
+}
+SUBSYSTEMS = tuple(sorted(set().union(*REFRESH.values())))
+
+
+class PlayerState:
+    # MPD's status, current song, outputs and queue, kept in memory by the
+    # idle watcher: each notification fetches again only what its subsystems
+    # cover. Reads ask MPD instead while the copy can't be trusted.
+    def __init__(self, max_dirty=1.0):
+        self.watcher = None
+        self.lock = threading.Lock()
+        self.synced = False
+        self.status = {}
+        self.fetched_at = 0
+        self.currentsong = {}
+        self.outputs = []
+        self.queue = []
+        # The playlist version each queue entry last changed in
+        self.changed = []
+        self.connection = None
+        self.mpd_version = None
+
+        # Changes made through wempd, and how many of them idle has caught up
+        # with. Reads go to MPD in between, for up to max_dirty seconds in
+        # case the change changed nothing and no notification comes.
+        self.writes = 0
+        self.seen_writes = 0
+        self.dirty_since = 0
+        self.max_dirty = max_dirty
+        self.refreshes = 0
+        self.fallbacks = 0
+
+    def watch(self, watcher):
+        # Subscribe before anything that tells browsers about changes, so
+        # they find them here when they ask.
+        self.watcher = watcher
+        watcher.subscribe(self.on_idle, *SUBSYSTEMS)
+
+    def invalidate(self):
+        # Before wempd changes something in MPD
+        with self.lock:
+            self.writes += 1
+            self.dirty_since = time.monotonic()
+
+    def on_idle(self, changed, client):
+        # Everything on (re)connecting, as the watcher only marks itself
+        # connected after the first round of callbacks.
+        full = not self.synced or not self.watcher.connected.is_set()
+        writes = self.writes
+        fetch = [name for name, subs in REFRESH.items() if full or changed & subs]
+        since = 0 if full else int(self.status["playlist"])
+
+        client.command_list_ok_begin()
+        for name in fetch:
+            if name == "queue":
+                client.plchanges(since)
+            else:
+                getattr(client, name)()
+        try:
+            results = dict(zip(fetch, client.command_list_end()))
+        except BaseException:
+            self.synced = False
+            raise
+
+        with self.lock:
+            if "status" in results:
+                self.status = results["status"]
+                self.fetched_at = time.monotonic()
+            if "currentsong" in results:
+                self.currentsong = results["currentsong"]
+            if "outputs" in results:
+                self.outputs = results["outputs"]
+            if "queue" in results:
+                self.apply_changes(results["queue"])
+            if full:
+                host, port = client._sock.getpeername()[:2]
+                self.connection = f"{host}:{port}"
+                self.mpd_version = client.mpd_version
+            self.seen_writes = writes
+            self.synced = True
+            self.refreshes += 1
+
+    def apply_changes(self, changes):
+        version = int(self.status["playlist"])
+        length = int(self.status["playlistlength"])
+        del self.queue[length:]
+        del self.changed[length:]
+        self.queue += [None] * (length - len(self.queue))
+        self.changed += [version] * (length - len(self.changed))
+        for song in changes:
+            pos = int(song["pos"])
+            if pos < length:
+                self.queue[pos] = song
+                self.changed[pos] = version
+
+    def fresh(self):
+        if not self.synced or self.watcher is None:
+            return False
+        if not self.watcher.connected.is_set():
+            return False
+        if self.writes != self.seen_writes:
+            return time.monotonic() - self.dirty_since > self.max_dirty
+        return True
+
+    def use_mpd(self):
+        # With the lock held
+        if self.fresh():
+            return False
+        self.fallbacks += 1
+        return True
+
+    def current_status(self, client):
+        with self.lock:
+            status = None if self.use_mpd() else self.extrapolated_status()
+        return client.status() if status is None else status
+
+    def current_song(self, client):
+        with self.lock:
+            song = None if self.use_mpd() else dict(self.currentsong)
+        return client.currentsong() if song is None else song
+
+    def current_outputs(self, client):
+        with self.lock:
+            outputs = None if self.use_mpd() else [dict(o) for o in self.outputs]
+        return client.outputs() if outputs is None else outputs
+
+    def current_queue(self, client):
+        # Like list_queue, the entries are shared so mustn't be changed
+        with self.lock:
+            queue = None if self.use_mpd() else self.marked_queue()
+        return list_queue(client) if queue is None else queue
+
+    def queue_changes(self, client, since):
+        with self.lock:
+            changes = None if self.use_mpd() else self.changes_since(since)
+        return queue_changes(client, since) if changes is None else changes
+
+    def get_status(self, client, since=None):
+        # What api.get_status returns, all from the same moment
+        with self.lock:
+            if self.use_mpd():
+                result = None
+            else:
+                result = {
+                    "status": self.extrapolated_status(),
+                    "currentsong": dict(self.currentsong),
+                    "connection": self.connection,
+                    "queue": (
+                        self.marked_queue()
+                        if since is None
+                        else self.changes_since(since)
+                    ),
+                    "version": self.mpd_version,
+                }
+        return get_status(client, since) if result is None else result
+
+    def extrapolated_status(self):
+        # With the lock held. Time moves on without notifications.
+        status = dict(self.status)
+        if status.get("state") == "play" and "elapsed" in status:
+            elapsed = float(status["elapsed"]) + time.monotonic() - self.fetched_at
+            if "duration" in status:
+                elapsed = min(elapsed, float(status["duration"]))
+            status["elapsed"] = f"{elapsed:.3f}"
+            if "time" in status:
+                status["time"] = f"{int(elapsed)}:{status['time'].split(':')[-1]}"
+        return status
+
+    def marked_queue(self):
+        # With the lock held, the current song marked like list_queue does
+        queue = list(self.queue)
+        if "song" in self.status:
+            pos = int(self.status["song"])
+            if pos < len(queue):
+                queue[pos] = {**queue[pos], "current": self.status["state"]}
+        return queue
+
+    def changes_since(self, since):
+        # What api.queue_changes returns, with the lock held
+        version = int(self.status["playlist"])
+        full = since == 0 or since > version
+        if full:
+            changes = list(self.queue)
+        else:
+            changes = [s for s, v in zip(self.queue, self.changed) if v > since]
+        return {
+            "version": version,
+            "length": len(self.queue),
+            "full": full,
+            "song": self.status.get("song"),
+            "state": self.status["state"],
+            "changes": changes,
+        }
+
+    def stats(self):
+        with self.lock:
+            return {
+                "fresh": self.fresh(),
+                "queue": len(self.queue),
+                "refreshes": self.refreshes,
+                "fallbacks": self.fallbacks,
+            }
+
+
+player_state = PlayerState()
@@ -0,0 +1,93 @@
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# URL path -> (file, content type)
+FILES = {
+    "/": ("index.html", "text/html; charset=utf-8"),
+    "/script.js": ("script.js", "application/javascript; charset=utf-8"),
+    "/manifest.json": ("manifest.json", "application/manifest+json"),
+    "/favicon.ico": ("favicon.ico", "image/x-icon"),
+    "/favicon-16x16.png": ("favicon-16x16.png", "image/png"),
+    "/favicon-32x32.png": ("favicon-32x32.png", "image/png"),
+    "/favicon-96x96.png": ("favicon-96x96.png", "image/png"),
+}
+
+# Pages that reference other assets, and are rewritten to use hashed URLs
+ENTRY_POINTS = ("/",)
+
+
+def accepted_encodings(header):
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        try:
+            if params.startswith("q=") and float(params[2:]) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class Asset:
+    def __init__(self, body, content_type):
+        self.content_type = content_type
+        self.digest = hashlib.sha256(body).hexdigest()
+        self.version = self.digest[:12]
+        self.bodies = {"identity": body}
+
+        if not content_type.startswith(("text/", "application/")):
+            return
+        compressed = {"gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(body, quality=11)
+        for coding, data in compressed.items():
+            if len(data) < len(body):
+                self.bodies[coding] = data
+
+    def negotiate(self, accept_encoding):
+        accepted = accepted_encodings(accept_encoding)
+        for coding in ("br", "gzip"):
+            if coding in self.bodies and coding in accepted:
+                return coding
+        return "identity"
+
+    def etag(self, coding):
+        if coding == "identity":
+            return f'"{self.digest}"'
+        return f'"{self.digest}-{coding}"'
+
+
+def load_assets(directory=STATIC_DIR):
+    assets = {}
+    for path, (name, content_type) in FILES.items():
+        if path in ENTRY_POINTS:
+            continue
+        with open(os.path.join(directory, name), "rb") as f:
+            assets[path] = Asset(f.read(), content_type)
+
+    # Referenced assets get a content hash in their URL, so they can be cached
+    # forever and the entry point revalidated cheaply.
+    for path in ENTRY_POINTS:
+        name, content_type = FILES[path]
+        with open(os.path.join(directory, name), "r") as f:
+            body = f.read()
+        for asset_path, asset in assets.items():
+            ref = asset_path.removeprefix("/")
+            body = body.replace(f'"{ref}"', f'"{ref}?v={asset.version}"')
+        assets[path] = Asset(body.encode("utf-8"), content_type)
+
+    return assets
+
+
+static_assets = load_assets()
@@ -0,0 +1,187 @@
+import array
+import bisect
+import collections.abc
+import itertools
+import math
+
+
+class Song(collections.abc.Mapping):
+    # One row of a LibraryStore, read like the dict python-mpd2 would give.
+    # Values are made when asked for, nothing is copied up front.
+    __slots__ = ("store", "row")
+
+    def __init__(self, store, row):
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, key):
+        value = self.store.value(self.row, key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        store, row = self.store, self.row
+        return (key for key in store.keys if store.value(row, key) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Song({dict(self)!r})"
+
+
+class LibraryStore(collections.abc.Sequence):
+    # Songs as columns rather than a dict each: every tag is a reference into
+    # one table of distinct values (tuples for multi-valued tags), durations
+    # are packed doubles and files are an interned directory and a name.
+    def __init__(self, keys):
+        self.keys = keys
+        self.columns = {
+            key: array.array("I") for key in keys if key not in ("file", "duration")
+        }
+        self.dirs = array.array("I")
+        self.names = []
+        self.durations = array.array("d")
+        # Reference 0 is a missing tag. The interning table is only kept while
+        # appending, lookups by value scan the distinct values instead.
+        self.values = [None]
+        self.interned = {None: 0}
+        # Rows sorted by file
+        self.by_file = array.array("I")
+
+    def intern(self, value):
+        if isinstance(value, list):
+            value = tuple(value)
+        ref = self.interned.get(value)
+        if ref is None:
+            ref = self.interned[value] = len(self.values)
+            self.values.append(value)
+        return ref
+
+    def append(self, song):
+        folder, _, name = song["file"].rpartition("/")
+        self.dirs.append(self.intern(folder))
+        self.names.append(name)
+        self.durations.append(float(song.get("duration", "nan")))
+        for key, column in self.columns.items():
+            column.append(self.intern(song.get(key)))
+
+    def finish(self):
+        # After the last append
+        self.interned = None
+        self.by_file = array.array("I", sorted(range(len(self)), key=self.file))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        rows = range(len(self))[index]
+        if isinstance(rows, range):
+            return [Song(self, row) for row in rows]
+        return Song(self, rows)
+
+    def file(self, row):
+        folder = self.values[self.dirs[row]]
+        return f"{folder}/{self.names[row]}" if folder else self.names[row]
+
+    def value(self, row, key):
+        # What python-mpd2 would give for the tag, None when the song has none
+        if key == "file":
+            return self.file(row)
+        if key == "duration":
+            duration = self.durations[row]
+            return None if math.isnan(duration) else f"{duration:.3f}"
+        column = self.columns.get(key)
+        if column is None:
+            return None
+        value = self.values[column[row]]
+        return list(value) if isinstance(value, tuple) else value
+
+    def lookup(self, file):
+        # The row of the song with this file, None if there isn't one
+        i = bisect.bisect_left(self.by_file, file, key=self.file)
+        if i < len(self.by_file) and self.file(self.by_file[i]) == file:
+            return self.by_file[i]
+        return None
+
+    def parse(self, args):
+        # MPD's TAG VALUE filters and group TAG pairs, None when they use
+        # anything else, like filter expressions or tags not kept here.
+        filters, groups = [], []
+        if len(args) % 2:
+            return None
+        for tag, value in zip(args[::2], args[1::2]):
+            tag = tag.lower()
+            if not isinstance(value, str):
+                return None
+            if tag == "group" and value.lower() in self.columns:
+                groups.append(value.lower())
+            elif tag in self.columns or tag == "file":
+                filters.append((tag, value))
+            else:
+                return None
+        return filters, groups
+
+    def matching(self, filters):
+        # Rows matching every filter, None for all of them
+        rows = None
+        for tag, value in filters:
+            if tag == "file":
+                row = self.lookup(value)
+                found = [] if row is None else [row]
+                rows = found if rows is None else [r for r in rows if r in found]
+                continue
+
+            # References to the values matching, any one of a multi-valued tag's
+            # will do and "" matches songs without the tag, like MPD.
+            refs = {
+                ref
+                for ref, v in enumerate(self.values)
+                if v == value or (isinstance(v, tuple) and value in v)
+            }
+            if value == "":
+                refs.add(0)
+            if rows is None:
+                rows = range(len(self))
+            rows = [row for row, ref in zip(rows, self.refs(tag, rows)) if ref in refs]
+        return rows
+
+    def refs(self, key, rows=None):
+        # The column's references for the rows, the artist's for songs without
+        # an album artist as MPD falls back to it.
+        column = self.columns[key]
+        if key != "albumartist" or "artist" not in self.columns:
+            return column if rows is None else (column[row] for row in rows)
+        artists = self.columns["artist"]
+        if rows is None:
+            return (ref or artist for ref, artist in zip(column, artists))
+        return (column[row] or artists[row] for row in rows)
+
+    def expand(self, ref):
+        value = self.values[ref]
+        if value is None:
+            return ("",)
+        return value if isinstance(value, tuple) else (value,)
+
+    def list(self, tag, *args):
+        # What MPD's list returns, None when it can't be answered here
+        parsed = self.parse(args)
+        if parsed is None or tag.lower() not in self.columns:
+            return None
+        filters, groups = parsed
+        keys = (*groups, tag.lower())
+        rows = self.matching(filters)
+        combos = set(zip(*(self.refs(key, rows) for key in keys)))
+        listed = set()
+        for combo in combos:
+            listed.update(itertools.product(*(self.expand(ref) for ref in combo)))
+        return [dict(zip(keys, values)) for values in sorted(listed)]
+
+    def find(self, *args):
+        # What MPD's find returns, None when it can't be answered here
+        parsed = self.parse(args)
+        if parsed is None or parsed[1]:
+            return None
+        rows = self.matching(parsed[0])
+        return self[:] if rows is None else [Song(self, row) for row in rows]
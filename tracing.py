@@ -0,0 +1,131 @@
+import cProfile
+import logging
+import os
+import re
+import threading
+import time
+import tracemalloc
+
+
+# Logged with their MPD commands when slower than this, 0 turns it off
+SLOW_REQUEST_SECONDS = float(os.getenv("WEMPD_SLOW_REQUEST_MS", "500")) / 1000
+# Profiles are only written when there's somewhere to put them
+PROFILE_DIR = os.getenv("WEMPD_PROFILE_DIR")
+# "cpu", "memory" or both, for every request rather than on request
+PROFILE = os.getenv("WEMPD_PROFILE", "")
+PROFILE_MODES = {"cpu", "memory"}
+
+
+class RequestTrace:
+    # The MPD commands one request issued, as (command, seconds, bytes read).
+    # Results read lazily in iterate mode count towards the time and bytes
+    # of whatever is read next, if anything.
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.commands = []
+
+    def record(self, command, seconds, received):
+        self.commands.append((command, seconds, received))
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        mpd_seconds = sum(seconds for _, seconds, _ in self.commands)
+        received = sum(received for _, _, received in self.commands)
+        commands = ", ".join(
+            f"{command} {seconds * 1000:.1f}ms {received}B"
+            for command, seconds, received in self.commands
+        )
+        return (
+            f"{self.method} {self.path} {elapsed * 1000:.1f}ms, "
+            f"{len(self.commands)} MPD commands {mpd_seconds * 1000:.1f}ms "
+            f"{received}B" + (f": {commands}" if commands else "")
+        )
+
+
+local = threading.local()
+
+
+def current_trace():
+    return getattr(local, "trace", None)
+
+
+def begin_trace(method, path):
+    local.trace = RequestTrace(method, path)
+    return local.trace
+
+
+def end_trace():
+    trace, local.trace = current_trace(), None
+    if trace is None:
+        return
+    if SLOW_REQUEST_SECONDS > 0:
+        if time.perf_counter() - trace.started >= SLOW_REQUEST_SECONDS:
+            logging.warning("Slow request %s", trace.summary())
+            return
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Request %s", trace.summary())
+
+
+def profile_modes(value):
+    return {mode.strip() for mode in value.lower().split(",")} & PROFILE_MODES
+
+
+class Profiler:
+    # cProfile and tracemalloc captures of single requests, written to
+    # <directory>/<unix ms>-<method>-<path>.pstats and .tracemalloc
+    def __init__(self, directory, default=""):
+        self.directory = directory
+        self.default = profile_modes(default)
+        # Only one cProfile can be enabled at once, and tracemalloc sees every
+        # thread anyway, so requests are profiled one at a time.
+        self.lock = threading.Lock()
+
+    def modes(self, header):
+        if not self.directory:
+            return set()
+        return self.default | profile_modes(header or "")
+
+    def start(self, modes):
+        # Returns what stop() needs, None when not profiling
+        if not modes:
+            return None
+        if not self.lock.acquire(blocking=False):
+            logging.debug("Already profiling a request, not this one")
+            return None
+
+        profile = None
+        if "cpu" in modes:
+            profile = cProfile.Profile()
+            profile.enable()
+        if "memory" in modes:
+            tracemalloc.start(25)
+        return profile, "memory" in modes
+
+    def stop(self, capture, method, path):
+        profile, memory = capture
+        try:
+            if profile is not None:
+                profile.disable()
+            snapshot = tracemalloc.take_snapshot() if memory else None
+        finally:
+            if memory:
+                tracemalloc.stop()
+            self.lock.release()
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = "{}-{}-{}".format(
+            int(time.time() * 1000),
+            method,
+            re.sub(r"[^\w.-]+", "_", path).strip("_") or "root",
+        )
+        base = os.path.join(self.directory, name)
+        if profile is not None:
+            profile.dump_stats(base + ".pstats")
+        if snapshot is not None:
+            snapshot.dump(base + ".tracemalloc")
+        logging.info("Profiled %s %s to %s", method, path, base)
+
+
+profiler = Profiler(PROFILE_DIR, PROFILE)
@@ -1,31 +1,170 @@
+import concurrent.futures
+import gzip
 import http.server
 import json
 import logging
 import mpd
 import os
+import queue
+import selectors
+import socket
+import threading
+import time
 import urllib.parse
+import zlib
 
 from api import (
-    get_status,
+    batch_commands,
+    batch_failure,
+    connect_client,
     info_pairs,
-    init_client,
     insert,
-    list_albumartists,
-    list_albums,
-    list_artists,
+    int_param,
+    iterating,
     list_playlists,
-    list_queue,
-    list_titles,
+    page_window,
+    paginate,
     remove_from_queue_by_id,
     remove_from_queue_by_search,
     remove_path_prefix,
+    run_batch,
+    simplify_title,
     simplify_title_list,
 )
 
+from art import art_cache, thumbnail_format
+from cache import library_cache, page_cache
+from events import event_broadcaster, SUBSYSTEMS as EVENT_SUBSYSTEMS
+from facets import FACETS, facet_values, find_facet, insert_facet
+from idle import IdleWatcher
+from library import (
+    library_snapshot,
+    list_albumartists,
+    list_albums,
+    list_artists,
+    list_titles,
+)
+from metrics import metrics
+from pool import ConnectionPool
+from prefetch import art_prefetcher
+from router import Router
+from sampling import FILTERS as RANDOM_FILTERS, KINDS as RANDOM_KINDS, random_picks
+from search import search_library
+from state import player_state
+from static import accepted_encodings, static_assets
+from tracing import begin_trace, end_trace, profiler
+
 import html
 
 logging.basicConfig(level=logging.INFO)
 
+WORKERS = max(1, int(os.getenv("WEMPD_WORKERS", "8")))
+COMPRESS_MIN_SIZE = int(os.getenv("WEMPD_COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_LEVEL = int(os.getenv("WEMPD_COMPRESS_LEVEL", "6"))
+KEEPALIVE_TIMEOUT = float(os.getenv("WEMPD_KEEPALIVE_TIMEOUT", "15"))
+KEEPALIVE_REQUESTS = int(os.getenv("WEMPD_KEEPALIVE_REQUESTS", "100"))
+
+# Connections are checked out for the length of a request, the protocol stream
+# can't be shared between threads.
+mpd_pool = ConnectionPool(
+    connect_client,
+    size=int(os.getenv("WEMPD_MPD_POOL_SIZE", WORKERS)),
+    health_interval=float(os.getenv("WEMPD_MPD_HEALTH_INTERVAL", "30")),
+)
+
+idle_watcher = IdleWatcher(connect_client)
+idle_watcher.subscribe(library_cache.on_database, "database")
+idle_watcher.subscribe(library_snapshot.on_database, "database")
+# Before the events, so browsers find the changes they're told about
+player_state.watch(idle_watcher)
+idle_watcher.subscribe(event_broadcaster.on_idle, *EVENT_SUBSYSTEMS)
+# Options too, as turning random on or off changes the next song
+idle_watcher.subscribe(art_prefetcher.on_idle, "player", "playlist", "options")
+
+
+CACHES = {"library": library_cache, "page": page_cache, "art": art_cache}
+
+
+# Methods labelled as such, the rest are "other" so that clients can't make
+# up new series
+METRIC_METHODS = {"GET", "POST", "HEAD"}
+
+
+def cache_samples(key):
+    return lambda: [((name,), cache.stats()[key]) for name, cache in CACHES.items()]
+
+
+def hit_ratios():
+    ratios = []
+    for name, cache in CACHES.items():
+        stats = cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        ratios.append(((name,), stats["hits"] / lookups if lookups else None))
+    return ratios
+
+
+metrics.sample(
+    "wempd_mpd_connects_total",
+    "counter",
+    "MPD connections opened by the pool",
+    lambda: mpd_pool.stats()["connects"],
+)
+metrics.sample(
+    "wempd_mpd_dropped_total",
+    "counter",
+    "Pooled MPD connections dropped as broken or stale",
+    lambda: mpd_pool.stats()["dropped"],
+)
+metrics.sample(
+    "wempd_mpd_idle_connections",
+    "gauge",
+    "Pooled MPD connections not in use",
+    lambda: mpd_pool.stats()["idle"],
+)
+metrics.sample(
+    "wempd_cache_hits_total", "counter", "Cache hits", cache_samples("hits"), ("cache",)
+)
+metrics.sample(
+    "wempd_cache_misses_total",
+    "counter",
+    "Cache misses",
+    cache_samples("misses"),
+    ("cache",),
+)
+metrics.sample(
+    "wempd_cache_hit_ratio", "gauge", "Cache hits over lookups", hit_ratios, ("cache",)
+)
+metrics.sample(
+    "wempd_sse_clients",
+    "gauge",
+    "Browsers listening for events",
+    lambda: len(event_broadcaster.clients),
+)
+metrics.sample(
+    "wempd_player_state_fallbacks_total",
+    "counter",
+    "Player state reads that went to MPD as the copy wasn't fresh",
+    lambda: player_state.stats()["fallbacks"],
+)
+metrics.sample(
+    "wempd_library_songs",
+    "gauge",
+    "Songs in the indexed library",
+    lambda: library_snapshot.stats()["songs"],
+)
+
+
+def compress(body, accept_encoding):
+    if COMPRESS_LEVEL <= 0 or len(body) < COMPRESS_MIN_SIZE:
+        return body, None
+
+    accepted = accepted_encodings(accept_encoding)
+    if "gzip" in accepted:
+        return gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0), "gzip"
+    if "deflate" in accepted:
+        return zlib.compress(body, COMPRESS_LEVEL), "deflate"
+    return body, None
+
 
 def catch_pipe_errors(func):
     def trycatch(*args, **kwargs):
@@ -37,177 +176,586 @@ def catch_pipe_errors(func):
     return trycatch
 
 
+def catch_connection_errors(func):
+    def trycatch(self, *args, **kwargs):
+        try:
+            func(self, *args, **kwargs)
+        except mpd.base.ConnectionError as e:
+            print(f"MPD connection error: {e}")
+            if self.status_code is not None:
+                # Part of the response is out, all we can do is hang up
+                self.close_connection = True
+                return
+            self.return_json({"error": f"MPD connection error: {e}"}, code=503)
+
+    return trycatch
+
+
+class WorkerPoolHTTPServer(http.server.HTTPServer):
+    def __init__(self, server_address, handler_class, workers, keepalive_timeout=15):
+        super().__init__(server_address, handler_class)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="wempd-worker"
+        )
+        # Long lived connections handed off to another thread, so they don't
+        # hold on to a worker.
+        self.detached = set()
+
+        # Keep-alive connections wait for their next request here rather than
+        # on a worker. request -> (client address, requests served, deadline),
+        # only touched by the parking thread.
+        self.keepalive_timeout = keepalive_timeout
+        self.parked = {}
+        self.to_park = queue.SimpleQueue()
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.parking_thread = threading.Thread(
+            target=self.parking_loop, name="wempd-keepalive", daemon=True
+        )
+        self.parking_thread.start()
+
+    def detach(self, request):
+        self.detached.add(request)
+
+    def shutdown_request(self, request):
+        if request in self.detached:
+            self.detached.discard(request)
+            return
+        super().shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_worker, request, client_address, 0)
+
+    def process_request_worker(self, request, client_address, served):
+        handler = None
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self, served)
+        except Exception:
+            self.handle_error(request, client_address)
+
+        if handler is not None and not handler.close_connection:
+            self.park(request, client_address, handler.served)
+        else:
+            self.shutdown_request(request)
+
+    def park(self, request, client_address, served):
+        self.to_park.put((request, client_address, served))
+        self.waker.send(b"\0")
+
+    def parking_loop(self):
+        while True:
+            deadline = min((p[2] for p in self.parked.values()), default=None)
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is self.wakeup:
+                    self.wakeup.recv(4096)
+                    self.park_pending()
+                    continue
+
+                # The next request is coming, back to a worker with it
+                request = key.fileobj
+                self.selector.unregister(request)
+                client_address, served, _ = self.parked.pop(request)
+                self.executor.submit(
+                    self.process_request_worker, request, client_address, served
+                )
+
+            now = time.monotonic()
+            for request in [r for r, p in self.parked.items() if p[2] <= now]:
+                self.selector.unregister(request)
+                del self.parked[request]
+                self.shutdown_request(request)
+
+    def park_pending(self):
+        while True:
+            try:
+                request, client_address, served = self.to_park.get_nowait()
+            except queue.Empty:
+                return
+            deadline = time.monotonic() + self.keepalive_timeout
+            self.parked[request] = (client_address, served, deadline)
+            self.selector.register(request, selectors.EVENT_READ)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Handlers for paths under /api, GET ones take the query, POST ones the body
+api_routes = Router()
+
+
+class CountingWriter:
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return self.wfile.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.wfile, name)
+
+
 class MPDRequestHandler(http.server.BaseHTTPRequestHandler):
-    client = init_client(None)
+    protocol_version = "HTTP/1.1"
+    # For reading a request and writing its response, idle connections wait
+    # in the server between requests.
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body are separate writes, Nagle would hold the body back
+    # until the client acks the headers, which it delays on a kept connection.
+    disable_nagle_algorithm = True
+
+    def __init__(self, request, client_address, server, served=0):
+        # Requests answered on this connection before
+        self.served = served
+        super().__init__(request, client_address, server)
 
     def log_message(self, fmt, *msg):
         logging.debug(fmt, *msg)
 
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.request_pending():
+            self.handle_one_request()
+
+    def request_pending(self):
+        # Whether the next request is already in, maybe read into the buffer
+        # where the server's selector can't see it.
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def setup(self):
+        super().setup()
+        self.wfile = CountingWriter(self.wfile)
+
+    def parse_request(self):
+        self.started = time.perf_counter()
+        self.route = "unmatched"
+        self.status_code = None
+        self.wfile.written = 0
+        if not super().parse_request():
+            return False
+
+        self.served += 1
+        if self.served >= KEEPALIVE_REQUESTS:
+            self.close_connection = True
+
+        begin_trace(self.command, self.path)
+        modes = profiler.modes(self.headers.get("X-Wempd-Profile"))
+        self.profile = profiler.start(modes)
+        return True
+
+    def handle_one_request(self):
+        self.profile = None
+        try:
+            super().handle_one_request()
+        finally:
+            if getattr(self, "status_code", None) is None:
+                # Nothing was sent, only hanging up tells the client it's over
+                self.close_connection = True
+            else:
+                self.record_metrics()
+            end_trace()
+            if self.profile is not None:
+                profiler.stop(self.profile, self.command, self.path)
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
+    def record_metrics(self):
+        elapsed = time.perf_counter() - self.started
+        method = self.command if self.command in METRIC_METHODS else "other"
+        labels = (method, self.route)
+        coded = (*labels, self.status_code)
+        metrics.inc("wempd_http_requests_total", coded)
+        metrics.observe("wempd_http_request_seconds", coded, elapsed)
+        metrics.inc("wempd_http_sent_bytes_total", labels, self.wfile.written)
+        received = int(self.headers.get("Content-Length") or 0)
+        if received:
+            metrics.inc("wempd_http_received_bytes_total", labels, received)
+        self.status_code = None
+
+    def send_body(self, body, **headers):
+        body, coding = compress(body, self.headers.get("Accept-Encoding"))
+        self.send_headers(
+            content_encoding=coding,
+            content_length=len(body),
+            vary="Accept-Encoding",
+            **headers,
+        )
+        self.wfile.write(body)
+
     def return_json(self, data, code=200):
-        self.send_headers(content_type="application/json", code=code)
-        self.wfile.write(json.dumps(data).encode("utf-8"))
+        self.send_body(
+            json.dumps(data).encode("utf-8"), content_type="application/json", code=code
+        )
+
+    def return_json_list(self, items, query):
+        page = paginate(items, query)
+        if query.get("stream"):
+            self.stream_json(page, total_count=len(items))
+        else:
+            self.send_body(
+                json.dumps(page).encode("utf-8"),
+                content_type="application/json",
+                total_count=len(items),
+            )
+
+    def stream_json(self, items, total_count=None):
+        # Encode and send as we go rather than building the whole document
+        compressor = None
+        accepted = accepted_encodings(self.headers.get("Accept-Encoding"))
+        if COMPRESS_LEVEL > 0 and "gzip" in accepted:
+            compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+
+        chunked = self.request_version == "HTTP/1.1" == self.protocol_version
+        if not chunked:
+            self.close_connection = True
+        self.send_headers(
+            content_encoding="gzip" if compressor else None,
+            content_type="application/json",
+            total_count=total_count,
+            transfer_encoding="chunked" if chunked else None,
+            vary="Accept-Encoding",
+        )
+
+        def send(data):
+            if not data:
+                return
+            if chunked:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            else:
+                self.wfile.write(data)
+
+        def write(data):
+            send(compressor.compress(data) if compressor else data)
+
+        # Batch items so each write is a reasonable size
+        encode = json.JSONEncoder().encode
+        write(b"[")
+        sep = b""
+        batch = []
+        size = 0
+        for item in items:
+            batch.append(encode(item))
+            size += len(batch[-1])
+            if size >= 65536:
+                write(sep + ",".join(batch).encode("utf-8"))
+                sep = b","
+                batch = []
+                size = 0
+        if batch:
+            write(sep + ",".join(batch).encode("utf-8"))
+        write(b"]")
+
+        if compressor:
+            send(compressor.flush())
+        if chunked:
+            self.wfile.write(b"0\r\n\r\n")
 
     def return_json_fail(self, msg):
         print(f"Error: {msg}")
         self.return_json({"error": msg}, code=400)
 
     def handle_html_get(self, path, query):
-        resp, headers = html.handle_get(self.client, path, query)
-        self.send_headers(**headers)
-        self.wfile.write("\n".join(resp).encode("utf-8"))
+        route, func, args = html.router.resolve("GET", path)
+        if route is not None:
+            self.route = route.pattern
+        resp, headers = html.handle_get(self.client, path, query, func, args)
+        self.send_body("\n".join(resp).encode("utf-8"), **headers)
 
     def send_headers(
         self,
         cache_control="no-store",
         code=200,
         content_length=None,
+        content_encoding=None,
         content_type="text/html",
+        etag=None,
         location=None,
         refresh=None,
+        total_count=None,
+        transfer_encoding=None,
+        vary=None,
     ):
         self.send_response(code)
         self.send_header("Content-Type", content_type)
         self.send_header("Cache-Control", cache_control)
+        if content_encoding is not None:
+            self.send_header("Content-Encoding", content_encoding)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        if vary is not None:
+            self.send_header("Vary", vary)
         if location is not None:
             self.send_header("Location", location)
         if content_length is not None:
             self.send_header("Content-Length", content_length)
         if refresh is not None:
             self.send_header("Refresh", refresh)
+        if total_count is not None:
+            self.send_header("X-Total-Count", total_count)
+        if transfer_encoding is not None:
+            self.send_header("Transfer-Encoding", transfer_encoding)
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        elif self.request_version == "HTTP/1.0":
+            self.send_header("Connection", "keep-alive")
         self.end_headers()
 
-    def handle_get_api(self, path, query):
-        path = path.removeprefix("/api")
-        if path == "/albumartists":
-            self.return_json(list_albumartists(self.client))
-
-        elif path == "/albums":
-            self.return_json(list_albums(self.client, query))
+    def send_asset(self, asset, query):
+        coding = asset.negotiate(self.headers.get("Accept-Encoding"))
+        etag = asset.etag(coding)
+        if query.get("v") == asset.version:
+            cache_control = "max-age=31536000, immutable"
+        else:
+            cache_control = "no-cache"
+
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_headers(
+                code=304,
+                cache_control=cache_control,
+                etag=etag,
+                vary="Accept-Encoding",
+            )
+            return
 
-        elif path == "/art":
-            if "file" not in query:
-                self.return_json_fail("Missing 'file' parameter")
-                return
+        body = asset.bodies[coding]
+        self.send_headers(
+            cache_control=cache_control,
+            content_encoding=None if coding == "identity" else coding,
+            content_length=len(body),
+            content_type=asset.content_type,
+            etag=etag,
+            vary="Accept-Encoding",
+        )
+        self.wfile.write(body)
+
+    @api_routes.route("/albumartists")
+    def get_albumartists(self, query):
+        self.return_json(list_albumartists(self.client))
+
+    @api_routes.route("/albums")
+    def get_albums(self, query):
+        self.return_json_list(list_albums(self.client, query), query)
+
+    @api_routes.route("/art")
+    def get_art(self, query):
+        if "file" not in query:
+            self.return_json_fail("Missing 'file' parameter")
+            return
 
-            try:
-                if self.client.mpd_version >= "0.22.0":
-                    pic = self.client.readpicture(query["file"])
-                else:
-                    pic = self.client.albumart(query["file"])
+        size = int_param(query, "size")
+        fmt = thumbnail_format(self.headers.get("Accept"))
+        art = art_cache.open(self.client, query["file"], size, fmt)
+        if art is None:
+            # No content means no body either
+            self.send_headers(code=204)
+            return
 
-                binary = pic["binary"]
+        f, meta = art
+        with f:
+            etag = f'"{meta["digest"]}"'
+            cache_control = "max-age=31536000, immutable"
+            # Thumbnails are WebP for browsers that take it
+            vary = "Accept" if size else None
+            if etag in self.headers.get("If-None-Match", ""):
                 self.send_headers(
-                    content_type=pic.get("type", "image/jpg"),
-                    content_length=len(binary),
-                    cache_control="max-age=31536000, immutable",
-                    code=200,
+                    code=304, cache_control=cache_control, etag=etag, vary=vary
                 )
-                self.wfile.write(binary)
-            except (KeyError, mpd.base.CommandError):
-                self.return_json({"Error": "No file exists"}, code=204)
-
-        elif path == "/artists":
-            self.return_json(list_artists(self.client))
-
-        elif path == "/count":
-            try:
-                self.return_json(self.client.count(*info_pairs(query)))
-            except mpd.base.CommandError as e:
-                self.return_json_fail(str(e))
-
-        elif path == "/info":
-            if "pos" in query:
-                self.return_json(self.client.playlistinfo(query["pos"])[0])
                 return
 
-            song_info = self.client.find(*info_pairs(query))
-            if song_info:
-                song_info = song_info[0]
-                self.return_json(song_info)
-            else:
-                self.return_json_fail("Could not find details")
-
-        elif path == "/outputs":
-            self.return_json(self.client.outputs())
+            self.send_headers(
+                content_type=meta["type"],
+                content_length=meta["size"],
+                cache_control=cache_control,
+                etag=etag,
+                code=200,
+                vary=vary,
+            )
+            self.wfile.flush()
+            self.wfile.written += self.connection.sendfile(f)
+
+    @api_routes.route("/artists")
+    def get_artists(self, query):
+        self.return_json(list_artists(self.client))
+
+    @api_routes.route("/facets")
+    def get_facets(self, query):
+        if not self.check_facet(query):
+            return
+        facet = query.get("facet", "genre")
+        if "value" in query:
+            songs = find_facet(self.client, facet, query["value"])
+            self.return_json_list(simplify_title_list(songs), query)
+        else:
+            values = facet_values(self.client, facet)
+            self.return_json([{"value": v, "count": c} for v, c in values])
 
-        elif path == "/search":
-            try:
-                lst = self.client.search("any", query["query"])
-                self.return_json(simplify_title_list(lst))
-            except KeyError:
-                self.return_json_fail("Missing parameter, 'query'")
+    @api_routes.route("/count")
+    def get_count(self, query):
+        try:
+            self.return_json(self.client.count(*info_pairs(query)))
+        except mpd.base.CommandError as e:
+            self.return_json_fail(str(e))
+
+    @api_routes.route("/events")
+    def get_events(self, query):
+        self.close_connection = True
+        self.send_headers(content_type="text/event-stream")
+        self.wfile.flush()
+        self.server.detach(self.request)
+        event_broadcaster.add(self.request)
+
+    @api_routes.route("/info")
+    def get_info(self, query):
+        if "pos" in query:
+            self.return_json(self.client.playlistinfo(query["pos"])[0])
+            return
 
-        elif path == "/playlists":
-            self.return_json(list_playlists(self.client))
+        song_info = self.client.find(*info_pairs(query))
+        if song_info:
+            song_info = song_info[0]
+            self.return_json(song_info)
+        else:
+            self.return_json_fail("Could not find details")
 
-        elif path == "/queue":
-            self.return_json(list_queue(self.client))
+    @api_routes.route("/outputs")
+    def get_outputs(self, query):
+        self.return_json(player_state.current_outputs(self.client))
 
-        elif path == "/stats":
-            stats = self.client.stats()
-            stats["mpd_version"] = self.client.mpd_version
-            stats["updating_db"] = self.client.status().get("updating_db")
-            self.return_json(stats)
+    @api_routes.route("/random")
+    def get_random(self, query):
+        kind = query.get("type", "album")
+        if kind not in RANDOM_KINDS:
+            self.return_json_fail(f"Unknown type, '{kind}'")
+            return
+        count = int_param(query, "count", 1) or 1
+        filters = [(f, query[f]) for f in RANDOM_FILTERS if f in query]
+        self.return_json(random_picks(self.client, kind, count, filters))
+
+    @api_routes.route("/search")
+    def get_search(self, query):
+        if "query" not in query:
+            self.return_json_fail("Missing parameter, 'query'")
+            return
 
-        elif path == "/status":
-            self.return_json(get_status(self.client))
+        limit = int_param(query, "limit")
+        if limit:
+            limit += int_param(query, "offset")
+        songs = search_library(query["query"], limit)
+        if songs is not None:
+            songs = paginate(songs, query)
+            if query.get("stream"):
+                self.stream_json(songs)
+            else:
+                self.return_json(songs)
+            return
 
-        elif path == "/titles":
-            self.return_json(list_titles(self.client, query))
+        # No index yet, MPD has to scan the library
+        search = ("any", query["query"], *page_window(query))
+        if query.get("stream"):
+            with iterating(self.client):
+                songs = self.client.search(*search)
+                self.stream_json(simplify_title(s) for s in songs)
+        else:
+            lst = self.client.search(*search)
+            self.return_json(simplify_title_list(lst))
+
+    @api_routes.route("/playlists")
+    def get_playlists(self, query):
+        self.return_json(list_playlists(self.client))
+
+    @api_routes.route("/queue")
+    def get_queue(self, query):
+        if "version" in query:
+            since = int_param(query, "version")
+            self.return_json(player_state.queue_changes(self.client, since))
+        else:
+            self.return_json(player_state.current_queue(self.client))
+
+    @api_routes.route("/stats")
+    def get_stats(self, query):
+        stats = self.client.stats()
+        stats["mpd_version"] = self.client.mpd_version
+        stats["updating_db"] = self.client.status().get("updating_db")
+        stats["cache"] = library_cache.stats()
+        stats["page_cache"] = page_cache.stats()
+        stats["art_cache"] = art_cache.stats()
+        stats["art_prefetch"] = art_prefetcher.stats()
+        stats["library"] = library_snapshot.stats()
+        stats["player_state"] = player_state.stats()
+        self.return_json(stats)
+
+    @api_routes.route("/status")
+    def get_status(self, query):
+        since = int_param(query, "version") if "version" in query else None
+        self.return_json(player_state.get_status(self.client, since))
+
+    @api_routes.route("/titles")
+    def get_titles(self, query):
+        self.return_json_list(list_titles(self.client, query), query)
 
     @catch_pipe_errors
+    @catch_connection_errors
     def do_GET(self):
-        MPDRequestHandler.client = init_client(self.client)
-
-        path_explode = urllib.parse.urlparse(self.path)
-        orig_path = path_explode.path
-        path = remove_path_prefix(orig_path)
-        query = urllib.parse.parse_qs(path_explode.query, keep_blank_values=True)
-        query = {k: v[-1] for k, v in query.items()}
+        path, query = self.parse_path()
 
         # Files
-        if path == "/":
-            with open("index.html", "r") as f:
-                self.send_headers()
-                self.wfile.write(f.read().encode("utf-8"))
-                return
+        if path in static_assets:
+            self.route = "static"
+            self.send_asset(static_assets[path], query)
+            return
 
-        if path == "/favicon.ico":
-            self.send_response(200)
-            self.end_headers()
+        if path == "/metrics":
+            self.route = path
+            self.send_body(
+                metrics.render().encode("utf-8"),
+                content_type="text/plain; version=0.0.4; charset=utf-8",
+            )
             return
 
-        if path == "/manifest.json":
-            with open("manifest.json", "rb") as f:
-                self.send_headers(content_type="application/manifest+json")
-                self.wfile.write(f.read())
-                return
+        def handle(client):
+            self.client = client
+            self.handle_get(path, query)
 
-        if path.removeprefix("/") in [
-            "favicon-16x16.png",
-            "favicon-32x32.png",
-            "favicon-96x96.png",
-        ]:
-            with open(path.removeprefix("/"), "rb") as f:
-                self.send_headers(content_type="image/png")
-                self.wfile.write(f.read())
-                return
+        # Until the response starts, a GET can run again if its pooled MPD
+        # connection turns out to be dead
+        mpd_pool.run(handle, retry=lambda: self.status_code is None)
 
-        if path == "/script.js":
-            with open("script.js", "r") as f:
-                self.send_headers(content_type="application/javascript")
-                self.wfile.write(f.read().encode("utf-8"))
-                return
+    @catch_connection_errors
+    def do_POST(self):
+        # The body is read first, so the connection can go on after an error
+        path, post_data = self.parse_post()
+        player_state.invalidate()
+        with mpd_pool.connection() as self.client:
+            self.handle_api("POST", path, post_data)
+
+    def parse_path(self):
+        path_explode = urllib.parse.urlparse(self.path)
+        path = remove_path_prefix(path_explode.path)
+        query = urllib.parse.parse_qs(path_explode.query, keep_blank_values=True)
+        query = {k: v[-1] for k, v in query.items()}
+        return path, query
 
+    def handle_get(self, path, query):
         # API
         if path.startswith("/api/"):
-            self.handle_get_api(path, query)
+            self.handle_api("GET", path, query)
         else:
             self.handle_html_get(path, query)
 
-    def do_POST(self):
-        MPDRequestHandler.client = init_client(self.client)
-
+    def parse_post(self):
         path_explode = urllib.parse.urlparse(self.path)
         path = remove_path_prefix(path_explode.path)
 
@@ -227,221 +775,301 @@ class MPDRequestHandler(http.server.BaseHTTPRequestHandler):
         else:
             post_data = json.loads(post_data)
 
-        if path.startswith("/api/"):
-            path = path.removeprefix("/api")
-            if path == "/add":
-                try:
-                    entry = post_data["entry"]
-                    self.client.add(entry)
-                    self.return_json({"added": 1})
-                except KeyError:
-                    self.return_json_fail("Missing parameter, 'entry'")
-                except mpd.base.CommandError as e:
-                    self.return_json_fail(str(e))
-
-            elif path == "/append":
-                self.return_json(
-                    {"appended": insert(self.client, post_data, append=True)}
-                )
-
-            elif path == "/clear":
-                count = len(self.client.playlist())
-                self.client.clear()
-                self.return_json({"removed": count})
-
-            elif path == "/consume":
-                state = post_data.get("enabled", ["1"])
-
-                if state not in ("1", "0"):
-                    self.return_json_fail("Parameter, 'enabled', should be '1' or '0'")
-                    return
+        return path, post_data
 
-                self.client.consume(state)
-                self.return_json({})
+    def handle_api(self, method, path, data):
+        route, handler, args = api_routes.resolve(method, path.removeprefix("/api"))
+        if route is not None:
+            self.route = "/api" + route.pattern
+        if route is None:
+            self.return_json_fail(f"Unrecognised {method} path: {path}")
+        elif handler is None:
+            self.return_json({"error": f"{method} not allowed on {path}"}, code=405)
+        else:
+            handler(self, data, *args)
+
+    def check_facet(self, data):
+        if "facet" in data and data["facet"] not in FACETS:
+            self.return_json_fail(f"Unknown facet, '{data['facet']}'")
+            return False
+        return True
+
+    def insert(self, post_data, append=False):
+        if "facet" in post_data:
+            value = post_data.get("value", "")
+            return insert_facet(self.client, post_data["facet"], value, append)
+        return insert(self.client, post_data, append)
+
+    @api_routes.route("/add", methods=("POST",))
+    def post_add(self, post_data):
+        try:
+            entry = post_data["entry"]
+            self.client.add(entry)
+            self.return_json({"added": 1})
+        except KeyError:
+            self.return_json_fail("Missing parameter, 'entry'")
+        except mpd.base.CommandError as e:
+            self.return_json_fail(str(e))
+
+    @api_routes.route("/append", methods=("POST",))
+    def post_append(self, post_data):
+        if self.check_facet(post_data):
+            self.return_json({"appended": self.insert(post_data, append=True)})
+
+    @api_routes.route("/batch", methods=("POST",))
+    def post_batch(self, post_data):
+        if not isinstance(post_data, dict):
+            self.return_json_fail("Body should be a JSON object")
+            return
+        try:
+            commands = batch_commands(post_data.get("ops"))
+            since = post_data.get("version")
+            since = None if since is None else int(since)
+        except (TypeError, ValueError) as e:
+            self.return_json_fail(str(e))
+            return
 
-            elif path == "/delete":
-                len_before = len(self.client.playlist())
-                try:
-                    pos_from = max(0, post_data["from"])
-                    pos_to = min(post_data["to"], len_before)
-                except KeyError:
-                    self.return_json_fail("Missing parameter 'from' or 'to'")
+        try:
+            self.return_json(run_batch(self.client, commands, since))
+        except mpd.base.CommandError as e:
+            print(f"Error: {e}")
+            self.return_json(batch_failure(self.client, e, since), code=400)
+
+    @api_routes.route("/clear", methods=("POST",))
+    def post_clear(self, post_data):
+        count = len(self.client.playlist())
+        self.client.clear()
+        self.return_json({"removed": count})
+
+    @api_routes.route("/consume", methods=("POST",))
+    def post_consume(self, post_data):
+        state = post_data.get("enabled", ["1"])
+
+        if state not in ("1", "0"):
+            self.return_json_fail("Parameter, 'enabled', should be '1' or '0'")
+            return
 
-                self.client.delete((pos_from, pos_to))
-                len_after = len(self.client.playlist())
-                self.return_json({"removed": len_before - len_after})
+        self.client.consume(state)
+        self.return_json({})
 
-            elif path == "/disableoutput" or path == "/enableoutput":
-                try:
-                    outputid = post_data["outputid"]
-                except KeyError:
-                    self.return_json_fail("Missing parameter 'outputid'")
-
-                if path == "/enableoutput":
-                    self.client.enableoutput(outputid)
-                else:
-                    self.client.disableoutput(outputid)
-                self.return_json({})
+    @api_routes.route("/delete", methods=("POST",))
+    def post_delete(self, post_data):
+        len_before = len(self.client.playlist())
+        try:
+            pos_from = max(0, post_data["from"])
+            pos_to = min(post_data["to"], len_before)
+        except KeyError:
+            self.return_json_fail("Missing parameter 'from' or 'to'")
 
-            elif path == "/insert":
-                self.return_json({"inserted": insert(self.client, post_data)})
+        self.client.delete((pos_from, pos_to))
+        len_after = len(self.client.playlist())
+        self.return_json({"removed": len_before - len_after})
 
-            elif path == "/move":
-                if not ("from" in post_data and "to" in post_data):
-                    self.return_json_fail("Missing parameter")
+    @api_routes.route("/disableoutput", methods=("POST",))
+    def post_disableoutput(self, post_data):
+        try:
+            outputid = post_data["outputid"]
+        except KeyError:
+            self.return_json_fail("Missing parameter 'outputid'")
+            return
 
-                self.client.move(post_data["from"], post_data["to"])
-                self.return_json({})
+        self.client.disableoutput(outputid)
+        self.return_json({})
 
-            elif path == "/next":
-                try:
-                    self.client.next()
-                    self.return_json({})
-                except mpd.base.CommandError as e:
-                    self.return_json_fail(str(e))
+    @api_routes.route("/enableoutput", methods=("POST",))
+    def post_enableoutput(self, post_data):
+        try:
+            outputid = post_data["outputid"]
+        except KeyError:
+            self.return_json_fail("Missing parameter 'outputid'")
+            return
 
-            elif path == "/pause":
-                try:
-                    if (
-                        self.client.status()["state"] == "stop"
-                        and self.client.playlist()
-                    ):
-                        self.client.play(0)
-                    else:
-                        self.client.pause()
-                    self.return_json({})
-                except mpd.base.CommandError as e:
-                    self.return_json_fail(str(e))
-
-            elif path == "/play":
-                try:
-                    play_id = int(post_data["id"])
-                    self.client.play(play_id)
-                    self.return_json({})
-                except ValueError:
-                    self.return_json_fail("Invalid parameter, 'id'")
-
-            elif path == "/prev":
-                self.client.previous()
-                self.return_json({})
+        self.client.enableoutput(outputid)
+        self.return_json({})
 
-            elif path == "/random":
-                state = post_data.get("enabled", ["1"])
+    @api_routes.route("/insert", methods=("POST",))
+    def post_insert(self, post_data):
+        if self.check_facet(post_data):
+            self.return_json({"inserted": self.insert(post_data)})
 
-                if state not in ("1", "0"):
-                    self.return_json_fail("Parameter, 'enabled', should be '1' or '0'")
-                    return
+    @api_routes.route("/move", methods=("POST",))
+    def post_move(self, post_data):
+        if not ("from" in post_data and "to" in post_data):
+            self.return_json_fail("Missing parameter")
 
-                self.client.random(state)
-                self.return_json({})
+        self.client.move(post_data["from"], post_data["to"])
+        self.return_json({})
 
-            elif path == "/remove":
-                removed = 0
-                if "ids" in post_data:
-                    removed = remove_from_queue_by_id(self.client, post_data["ids"])
+    @api_routes.route("/next", methods=("POST",))
+    def post_next(self, post_data):
+        try:
+            self.client.next()
+            self.return_json({})
+        except mpd.base.CommandError as e:
+            self.return_json_fail(str(e))
 
-                else:
-                    for key in ("artist", "albumartist", "album", "title", "name"):
-                        if key in post_data:
-                            removed += remove_from_queue_by_search(
-                                self.client, key, post_data[key]
-                            )
+    @api_routes.route("/pause", methods=("POST",))
+    def post_pause(self, post_data):
+        try:
+            if (
+                self.client.status()["state"] == "stop"
+                and self.client.playlist()
+            ):
+                self.client.play(0)
+            else:
+                self.client.pause()
+            self.return_json({})
+        except mpd.base.CommandError as e:
+            self.return_json_fail(str(e))
 
-                self.return_json({"removed": removed})
+    @api_routes.route("/play", methods=("POST",))
+    def post_play(self, post_data):
+        try:
+            play_id = int(post_data["id"])
+            self.client.play(play_id)
+            self.return_json({})
+        except ValueError:
+            self.return_json_fail("Invalid parameter, 'id'")
+
+    @api_routes.route("/prev", methods=("POST",))
+    def post_prev(self, post_data):
+        self.client.previous()
+        self.return_json({})
+
+    @api_routes.route("/random", methods=("POST",))
+    def post_random(self, post_data):
+        state = post_data.get("enabled", ["1"])
+
+        if state not in ("1", "0"):
+            self.return_json_fail("Parameter, 'enabled', should be '1' or '0'")
+            return
 
-            elif path == "/removeplaylist":
-                self.client.rm(post_data["playlist"])
-                self.return_json({"removed": post_data["playlist"]})
+        self.client.random(state)
+        self.return_json({})
 
-            elif path == "/repeat":
-                state = post_data.get("enabled", ["1"])
+    @api_routes.route("/remove", methods=("POST",))
+    def post_remove(self, post_data):
+        if "ids" in post_data:
+            removed = remove_from_queue_by_id(self.client, post_data["ids"])
+        else:
+            searches = [
+                (key, post_data[key])
+                for key in ("artist", "albumartist", "album", "title", "name")
+                if key in post_data
+            ]
+            removed = remove_from_queue_by_search(self.client, searches)
+
+        self.return_json({"removed": removed})
+
+    @api_routes.route("/removeplaylist", methods=("POST",))
+    def post_removeplaylist(self, post_data):
+        self.client.rm(post_data["playlist"])
+        self.return_json({"removed": post_data["playlist"]})
+
+    @api_routes.route("/repeat", methods=("POST",))
+    def post_repeat(self, post_data):
+        state = post_data.get("enabled", ["1"])
+
+        if state not in ("1", "0"):
+            self.return_json_fail("Parameter, 'enabled', should be '1' or '0'")
+            return
 
-                if state not in ("1", "0"):
-                    self.return_json_fail("Parameter, 'enabled', should be '1' or '0'")
-                    return
+        self.client.repeat(state)
+        self.return_json({})
 
-                self.client.repeat(state)
+    @api_routes.route("/save", methods=("POST",))
+    def post_save(self, post_data):
+        try:
+            name = post_data["name"]
+            self.client.save(name)
+            self.return_json({"saved": name})
+        except KeyError:
+            self.return_json_fail("Missing parameter, 'name'")
+        except mpd.base.CommandError as e:
+            self.return_json_fail(str(e))
+
+    @api_routes.route("/seek", methods=("POST",))
+    def post_seek(self, post_data):
+        if "time" in post_data:
+            try:
+                new_time = float(post_data["time"])
+                self.client.seekcur(new_time)
                 self.return_json({})
+            except ValueError:
+                self.return_json_fail("Invalid parameter, 'time'")
 
-            elif path == "/save":
-                try:
-                    name = post_data["name"]
-                    self.client.save(name)
-                    self.return_json({"saved": name})
-                except KeyError:
-                    self.return_json_fail("Missing parameter, 'name'")
-                except mpd.base.CommandError as e:
-                    self.return_json_fail(str(e))
-
-            elif path == "/seek":
-                if "time" in post_data:
-                    try:
-                        new_time = float(post_data["time"])
-                        self.client.seekcur(new_time)
-                        self.return_json({})
-                    except ValueError:
-                        self.return_json_fail("Invalid parameter, 'time'")
-
-                elif "percentage" in post_data:
-                    try:
-                        perc = float(post_data["percentage"])
-                        status = self.client.status()
-                        new_time = (perc / 100) * float(status["duration"])
-                        self.client.seekcur(new_time)
-                        self.return_json({})
-                    except ValueError:
-                        self.return_json_fail("Invalid parameter, 'percentage'")
-
-            elif path == "/shuffle":
-                self.client.shuffle()
+        elif "percentage" in post_data:
+            try:
+                perc = float(post_data["percentage"])
+                status = self.client.status()
+                new_time = (perc / 100) * float(status["duration"])
+                self.client.seekcur(new_time)
                 self.return_json({})
+            except ValueError:
+                self.return_json_fail("Invalid parameter, 'percentage'")
 
-            elif path == "/single":
-                state = post_data.get("enabled", ["1"])
+    @api_routes.route("/shuffle", methods=("POST",))
+    def post_shuffle(self, post_data):
+        self.client.shuffle()
+        self.return_json({})
 
-                if state not in ("1", "0"):
-                    self.return_json_fail("Parameter, 'enabled', should be '1' or '0'")
-                    return
+    @api_routes.route("/single", methods=("POST",))
+    def post_single(self, post_data):
+        state = post_data.get("enabled", ["1"])
 
-                self.client.single(state)
-                self.return_json({})
+        if state not in ("1", "0"):
+            self.return_json_fail("Parameter, 'enabled', should be '1' or '0'")
+            return
 
-            elif path == "/stop":
-                self.client.stop()
-                self.return_json({})
+        self.client.single(state)
+        self.return_json({})
 
-            elif path == "/update":
-                self.client.update()
-                self.return_json({})
+    @api_routes.route("/stop", methods=("POST",))
+    def post_stop(self, post_data):
+        self.client.stop()
+        self.return_json({})
 
-            elif path == "/volume":
-                try:
-                    if "volume" in post_data:
-                        # Adjust relative volume
-                        vol = int(post_data["volume"])
-                        self.client.volume(vol)
+    @api_routes.route("/update", methods=("POST",))
+    def post_update(self, post_data):
+        self.client.update()
+        self.return_json({})
+
+    @api_routes.route("/volume", methods=("POST",))
+    def post_volume(self, post_data):
+        try:
+            if "volume" in post_data:
+                # Adjust relative volume
+                vol = int(post_data["volume"])
+                self.client.volume(vol)
 
-                    elif "setvol" in post_data:
-                        # Set new absolute volume
-                        vol = int(post_data["setvol"])
-                        self.client.setvol(vol)
+            elif "setvol" in post_data:
+                # Set new absolute volume
+                vol = int(post_data["setvol"])
+                self.client.setvol(vol)
 
-                    new_volume = self.client.status()["volume"]
-                    self.return_json({"volume": new_volume})
-                except mpd.base.CommandError as e:
-                    self.return_json_fail(str(e))
+            new_volume = self.client.status()["volume"]
+            self.return_json({"volume": new_volume})
+        except mpd.base.CommandError as e:
+            self.return_json_fail(str(e))
 
-            else:
-                self.return_json_fail(f"Unrecognised POST path: {path}")
 
+api_routes.compile()
 
 if __name__ == "__main__":
     hostname = os.getenv("WEMPD_LISTEN_ADDRESS", "0.0.0.0")
     port = int(os.getenv("WEMPD_LISTEN_PORT", "8010"))
-    print(f"Listening on: {hostname}:{port}")
-    httpd = http.server.HTTPServer((hostname, port), MPDRequestHandler)
+    print(f"Listening on: {hostname}:{port} ({WORKERS} workers)")
+    mpd_pool.start()
+    event_broadcaster.start()
+    library_snapshot.start()
+    art_prefetcher.start(mpd_pool.connection)
+    idle_watcher.start()
+    httpd = WorkerPoolHTTPServer(
+        (hostname, port), MPDRequestHandler, WORKERS, KEEPALIVE_TIMEOUT
+    )
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         pass
     httpd.server_close()
+    mpd_pool.stop()